@@ -5,48 +5,46 @@ Author:      Deanna Nash, dnash@ucsd.edu
 Description: functions to build interactive html table for website
 """
 
+import os
 import numpy as np
 import pandas as pd
 import xarray as xr
 from datetime import timedelta
 
+import instrument
+from publish_funcs import publish_text
 
-def highlight_1(s, props=''):
-    # return np.where(s == 100, props, '')
-    return np.where(s.str.contains('^100'), props, '')
 
-def highlight_99(s, props=''):
-    # return np.where(s == 99, props, '')
-    return np.where(s.str.contains('^99'), props, '')
+## lower bound (percentile) of each table color bin and the CSS class of the bin
+percentile_bins = [0, 75, 90, 95, 96, 97, 98, 99, 100]
+percentile_classes = ['p0', 'p75', 'p90', 'p95', 'p96', 'p97', 'p98', 'p99', 'p100']
 
-def highlight_98(s, props=''):
-    # return np.where(s == 98, props, '')
-    return np.where(s.str.contains('^98'), props, '')
+## background color of each bin for each table column (text is white from the 98th percentile up)
+table_colors = {'IVT': ['#ffffe5', '#f7fcb9', '#d9f0a3', '#addd8e', '#78c679', '#41ab5d', '#006837', '#238443', '#004529'],
+                'Z0': ['#ffffcc', '#ffeda0', '#fed976', '#feb24c', '#fd8d3c', '#fc4e2a', '#e31a1c', '#bd0026', '#800026'],
+                'UV': ['#f7fcfd', '#e0ecf4', '#bfd3e6', '#9ebcda', '#8c96c6', '#8c6bb1', '#88419d', '#810f7c', '#4d004b']}
 
-def highlight_97(s, props=''):
-    # return np.where(s == 97, props, '')
-    return np.where(s.str.contains('^97'), props, '')
+## table column and dataset variable of each forecast variable
+table_columns = [('IVT', 'ivt'), ('Z0', 'freezing_level'), ('UV', 'uv')]
 
-def highlight_96(s, props=''):
-    # return np.where(s == 96, props, '')
-    return np.where(s.str.contains('^96'), props, '')
+def percentile_bin_classes(vals, column):
+    ## CSS classes of each value, e.g., 'IVT p99', with one binning operation for the column
+    idx = np.digitize(vals, percentile_bins[1:])
+    return np.char.add(column + ' ', np.asarray(percentile_classes)[idx])
 
-def highlight_95(s, props=''):
-    # return np.where(s == 95, props, '')
-    return np.where(s.str.contains('^95'), props, '')
+def table_stylesheet(columns):
+    ## one CSS rule per column and bin instead of a style for every cell
+    styles = []
+    for column in columns:
+        for i, color in enumerate(table_colors[column]):
+            text_color = 'white' if percentile_bins[i] >= 98 else 'black'
+            styles.append({'selector': 'td.{0}.{1}'.format(column, percentile_classes[i]),
+                           'props': 'color:{0};background-color: {1};'.format(text_color, color)})
+    return styles
 
-def highlight_90_94(s, props=''):
-    # return np.where((s >= 90) & (s <= 94), props, '')
-    idx = (s.str.contains('^94')) | (s.str.contains('^93')) | (s.str.contains('^92')) | (s.str.contains('^91')) | (s.str.contains('^90')) 
-    return np.where(idx, props, '')
-
-def highlight_75(s, props=''):
-    # return np.where(s == 75, props, '')
-    return np.where(s.str.contains('^75'), props, '')
-
-def highlight_0(s, props=''):
-    # return np.where(s == 0, props, '')
-    return np.where(s.str.contains('^0'), props, '')
+def percentile_to_int(vals):
+    ## floor so continuous percentile ranks (e.g., 99.6) stay in their bin
+    return np.floor(np.round(vals*100, 6))
    
 def make_clickable_Z0(s):
     z0_val, step = s.split(";")
@@ -81,22 +79,73 @@ def make_clickable_uv1000(s):
         link = '<a href="#image" onclick="{0}" style=text-decoration:none;color:black>{1}</a>'.format(string_arg, uv1000_val)
     return link
 
-def make_clickable_F(s):
+def make_clickable_F(s, img_path='images/images_operational/'):
     domain, step = s.split(";")
-    fname = 'images/images_operational/{1}_mclimate_F{0}.png'.format(step, domain)
+    fname = img_path + '{1}_mclimate_F{0}.png'.format(step, domain)
     string_arg = "image.src='{0}'".format(fname)
     link = '<a href="#image" onclick="{0}" style=text-decoration:none;color:black>{1}</a>'.format(string_arg, step)
     return link
     
-def create_html_table(ds, domain):
-    if domain == 'SEAK':
-        ext = [-141., -130., 54., 60.]
-    else:
-        ext = [-170., -120., 40., 65.]
+class html_page_template:
+    '''
+    Header and footer of the html page, read once and reused for every page rendered
+    
+    Parameters
+    ----------
+    header_fname : str
+        text file with the html before the table
+    footer_fname : str
+        text file with the html after the table
+    
+    '''
+    def __init__(self, header_fname, footer_fname):
+        self.fnames = (header_fname, footer_fname)
+        self.mtimes = self.get_mtimes()
+        with open(header_fname, mode='r') as f:
+            self.header = f.read()
+        with open(footer_fname, mode='r') as f:
+            self.footer = f.read()
+
+    def get_mtimes(self):
+        return tuple([os.path.getmtime(fname) for fname in self.fnames])
+
+    def is_current(self):
+        ## False if the header or footer file changed since it was read
+        return self.get_mtimes() == self.mtimes
+
+    def render(self, df_html):
+        ## the whole page in memory
+        return ''.join([self.header, df_html, self.footer])
+
+## page templates already read in this process, keyed by (header_fname, footer_fname)
+page_templates = {}
+
+def get_page_template(header_fname, footer_fname):
+    key = (header_fname, footer_fname)
+    if (key not in page_templates) or (page_templates[key].is_current() == False):
+        page_templates[key] = html_page_template(header_fname, footer_fname)
+    return page_templates[key]
+
+@instrument.timed()
+def write_html_page(df_html, out_fname, header_fname, footer_fname):
+    ## render the header, table and footer and move the page into place in one rename
+    page = get_page_template(header_fname, footer_fname).render(df_html)
+    publish_text(page, out_fname)
+
+@instrument.timed()
+def create_html_table(ds, domain, ext=None, img_path='images/images_operational/'):
+    ## ext [minlon, maxlon, minlat, maxlat] overrides the default extent of the domain
+    if ext is None:
+        if domain == 'SEAK':
+            ext = [-141., -130., 54., 60.]
+        else:
+            ext = [-170., -120., 40., 65.]
         
     ## create html table with max value within extent
     tmp = ds.sel(lat=slice(ext[2], ext[3]), lon=slice(ext[0], ext[1]))
     maxval = tmp.max(dim=['lat', 'lon']).fillna(0)
+    ## steps where a variable has no data at all (e.g., an optional variable that was not ready yet) are shown as NA
+    nodata = tmp.count(dim=['lat', 'lon']) == 0
     
     ## create list of valid dates
     ts = pd.to_datetime(ds.init_date.values, format="%Y%m%d%H")
@@ -120,14 +169,12 @@ def create_html_table(ds, domain):
     arrays = [col2, col3]
     tuples = list(zip(*arrays))
     index = pd.MultiIndex.from_tuples(tuples, names=["Date", "Hour"])
-    ivt_vals = maxval.ivt.values*100
-    fl_vals = maxval.freezing_level.values*100
-    uv_vals = maxval.uv.values*100
-        
-    data = {'F': str_lst,
-            'IVT': [f"{num:.0f}" for num in ivt_vals],
-            'Z0': [f"{num:.0f}" for num in fl_vals],
-            'UV': [f"{num:.0f}" for num in uv_vals]}
+    ## one column for each variable in ds
+    vals = {column: percentile_to_int(maxval[dvar].values) for column, dvar in table_columns if dvar in maxval}
+    data = {'F': str_lst}
+    for column in vals:
+        vals[column] = np.where(nodata[dict(table_columns)[column]].values, np.nan, vals[column])
+        data[column] = ['NA' if np.isnan(num) else f"{num:.0f}" for num in vals[column]]
     df = pd.DataFrame(data, index=index)
     
     ## get class values based on IVT values
@@ -140,40 +187,16 @@ def create_html_table(ds, domain):
     # lines2 = {'selector': 'td', 'props': 'border-bottom: 1px solid black; border-left: 1px solid black; border-right: 1px solid black;'} ## add a line to the bottom of each row
     border = {'selector': ' : ', 'props': 'border: 1px solid black'}
     # apply style formatting
-    slice_ = ['IVT']
-    slice2_ = ['Z0']
-    slice3_ = ['UV']
     sliceF_ = ['F']
-
-    df = df.style.format(make_clickable_F, escape="html", na_rep="NA", subset=sliceF_)\
-           .apply(highlight_1, props='color:white;background-color: #800026;', axis=0, subset=slice2_)\
-           .apply(highlight_99, props='color:white;background-color: #bd0026;', axis=0, subset=slice2_)\
-           .apply(highlight_98, props='color:white;background-color: #e31a1c;', axis=0, subset=slice2_)\
-           .apply(highlight_97, props='color:black;background-color: #fc4e2a', axis=0, subset=slice2_)\
-           .apply(highlight_96, props='color:black;background-color: #fd8d3c', axis=0, subset=slice2_)\
-           .apply(highlight_95, props='color:black;background-color: #feb24c', axis=0, subset=slice2_)\
-           .apply(highlight_90_94, props='color:black;background-color: #fed976', axis=0, subset=slice2_)\
-           .apply(highlight_75, props='color:black;background-color: #ffeda0', axis=0, subset=slice2_)\
-           .apply(highlight_0, props='color:black;background-color: #ffffcc', axis=0, subset=slice2_)\
-           .apply(highlight_1, props='color:white;background-color: #004529;', axis=0, subset=slice_)\
-           .apply(highlight_99, props='color:white;background-color: #238443;', axis=0, subset=slice_)\
-           .apply(highlight_98, props='color:white;background-color: #006837;', axis=0, subset=slice_)\
-           .apply(highlight_97, props='color:black;background-color: #41ab5d', axis=0, subset=slice_)\
-           .apply(highlight_96, props='color:black;background-color: #78c679', axis=0, subset=slice_)\
-           .apply(highlight_95, props='color:black;background-color: #addd8e', axis=0, subset=slice_)\
-           .apply(highlight_90_94, props='color:black;background-color: #d9f0a3', axis=0, subset=slice_)\
-           .apply(highlight_75, props='color:black;background-color: #f7fcb9', axis=0, subset=slice_)\
-           .apply(highlight_0, props='color:black;background-color: #ffffe5', axis=0, subset=slice_)\
-           .apply(highlight_1, props='color:white;background-color: #4d004b;', axis=0, subset=slice3_)\
-           .apply(highlight_99, props='color:white;background-color: #810f7c;', axis=0, subset=slice3_)\
-           .apply(highlight_98, props='color:white;background-color: #88419d;', axis=0, subset=slice3_)\
-           .apply(highlight_97, props='color:black;background-color: #8c6bb1;', axis=0, subset=slice3_)\
-           .apply(highlight_96, props='color:black;background-color: #8c96c6;', axis=0, subset=slice3_)\
-           .apply(highlight_95, props='color:black;background-color: #9ebcda;', axis=0, subset=slice3_)\
-           .apply(highlight_90_94, props='color:black;background-color: #bfd3e6;', axis=0, subset=slice3_)\
-           .apply(highlight_75, props='color:black;background-color: #e0ecf4;', axis=0, subset=slice3_)\
-           .apply(highlight_0, props='color:black;background-color: #f7fcfd;', axis=0, subset=slice3_)\
-           .set_table_styles([cell_hover, index_names])\
+    
+    ## CSS class of each cell from its percentile
+    classes = pd.DataFrame('', index=df.index, columns=df.columns)
+    for column in vals:
+        classes[column] = np.where(np.isnan(vals[column]), '', percentile_bin_classes(vals[column], column))
+
+    df = df.style.format(lambda s: make_clickable_F(s, img_path), escape="html", na_rep="NA", subset=sliceF_)\
+           .set_td_classes(classes)\
+           .set_table_styles([cell_hover, index_names] + table_stylesheet(vals.keys()))\
            .set_caption("{0}".format(init_time))
 
 
@@ -7,16 +7,16 @@ Description: a collection of useful constants, colors, useful plotting and loadi
 
 import os
 import re
-import shutil
+import json
+import time
 import subprocess
-import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import xarray as xr
 import pandas as pd
 import datetime
 import numpy as np
-import cartopy.crs as ccrs
-import cmocean.cm as cmo
-from PIL import Image
+
+import instrument
 
 def plot_cw3e_logo(ax, orientation):
     ## location of CW3E logo
@@ -24,6 +24,7 @@ def plot_cw3e_logo(ax, orientation):
         im = '/common/CW3E_Logo_Suite/1-Horzontal-PRIMARY_LOGO/Digital/JPG-RGB/CW3E-Logo-Horizontal-FullColor-RGB.jpg'
     else:
         im = '/common/CW3E_Logo_Suite/2-Vertical/Digital/JPG-RGB/CW3E-Logo-Vertical-FullColor-RGB.jpg'
+    from PIL import Image # only needed for plotting
     img = np.asarray(Image.open(im))
     ax.imshow(img)
     ax.axis('off')
@@ -55,6 +56,283 @@ def get_every_other_vector(x):
 def myround(x, base=5):
     return base * round(x/base)
 
+def index_to_slice(idx):
+    ## use a slice for contiguous indices so the file read is a single hyperslab
+    if (len(idx) > 0) and np.all(np.diff(idx) == 1):
+        return slice(idx[0], idx[-1]+1)
+    return idx
+
+def subset_domain(ds, ext=[-179.5, -110., 10., 70.]):
+    '''
+    Subsets a (lazy) dataset with 0-359 or -180-179 longitudes to [minlon, maxlon, minlat, maxlat]
+
+    The window is found on the longitudes in the file and only the subset is converted
+    to -180-179, so the longitudes stay sorted and only the window is read. Latitudes 
+    keep the order in the file.
+    '''
+    lon = (((ds.lon.values + 180) % 360) - 180)
+    ilon = np.nonzero((lon >= ext[0]) & (lon <= ext[1]))[0]
+    ilon = ilon[np.argsort(lon[ilon], kind='stable')]
+    ilat = np.nonzero((ds.lat.values >= ext[2]) & (ds.lat.values <= ext[3]))[0]
+    ds = ds.isel(lon=index_to_slice(ilon), lat=index_to_slice(ilat))
+    ds = ds.assign_coords({"lon": lon[ilon]})
+    return ds
+
+## directory for persistent GRIB message indexes (shared across runs and processes)
+grib_index_dir = '/data/projects/operations/GEFS_Mclimate/grib_index/'
+
+def calc_uv(ds):
+    ## wind speed from u and v
+    uv = np.sqrt(ds.u**2 + ds.v**2)
+    ds = ds.assign(uv=uv)
+    ds = ds.drop_vars(["u", "v"])
+    return ds
+
+## GRIB messages to decode for each variable, and how to derive the variable from them
+grib_products = {'freezing_level': {'filter_by_keys': {'typeOfLevel': 'isothermZero', 'shortName': 'gh'},
+                                    'rename': {'gh': 'freezing_level'},
+                                    'derive': None},
+                 'uv1000': {'filter_by_keys': {'typeOfLevel': 'isobaricInhPa', 'level': 1000},
+                            'rename': {},
+                            'derive': calc_uv}}
+
+def open_grib_variable(fname, varname, index_dir=grib_index_dir):
+    '''
+    Opens only the GRIB messages needed for varname (see grib_products)
+    
+    The cfgrib message index is kept in index_dir instead of next to the GRIB file,
+    so it is reused by later runs and other processes (cfgrib rebuilds it if the 
+    GRIB file is newer than the index).
+    
+    Parameters
+    ----------
+    fname : str
+        GRIB filename
+    varname : str
+        key in grib_products, e.g., 'freezing_level'
+    index_dir : str
+        directory for the message indexes (None writes them next to the GRIB file)
+  
+    Returns
+    -------
+    ds : xarray dataset
+        lazy dataset with lat and lon coordinates
+    
+    '''
+    product = grib_products[varname]
+    backend_kwargs = {'filter_by_keys': product['filter_by_keys']}
+    if index_dir is not None:
+        os.makedirs(index_dir, exist_ok=True)
+        ## the parent directory (the init date) keeps index names unique
+        stem = '_'.join(os.path.normpath(fname).split(os.sep)[-2:])
+        backend_kwargs['indexpath'] = os.path.join(index_dir, stem + '.{short_hash}.idx')
+    ds = xr.open_dataset(fname, engine='cfgrib', backend_kwargs=backend_kwargs)
+    ds = ds.rename({'longitude': 'lon', 'latitude': 'lat'})
+    ds = ds.rename(product['rename'])
+    if product['derive'] is not None:
+        ds = product['derive'](ds)
+    return ds
+
+def evict_grib_indexes(index_dir=grib_index_dir, max_age=72.):
+    '''
+    Removes the GRIB message indexes in index_dir that were written more than max_age hours ago,
+    so indexes of old forecasts don't accumulate (cfgrib rebuilds an evicted index if it is needed again)
+    '''
+    if (index_dir is None) or (os.path.isdir(index_dir) == False):
+        return
+    cutoff = time.time() - max_age*3600.
+    for entry in os.scandir(index_dir):
+        if entry.name.endswith('.idx') == False:
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass # removed by another process
+
+## where the forecast catalog indexes are kept between runs
+catalog_dir = '/data/projects/operations/GEFS_Mclimate/catalog/'
+## a directory modified within this many seconds of being listed may change again without its
+## modification time changing (coarse file system timestamps), so it is listed again next time
+racy_mtime = 2.
+
+class forecast_catalog:
+    '''
+    Incrementally updated index of the initialization dates and lead times in a forecast directory
+    
+    Init dates and lead times are parsed from the file names. A directory is only listed 
+    again when its modification time changes (i.e., files were added, removed or renamed), 
+    and no file is stat'ed, so finding the latest forecast does not scan the whole directory. 
+    A directory that was still changing when it was listed is listed again on the next update.
+    The index is saved to index_fname so later runs only rescan what changed.
+    
+    Parameters
+    ----------
+    fpath : str
+        forecast directory
+    pattern : str
+        regular expression matching the file names with an 'init' (YYYYMMDDHH) group 
+        and optionally a 'lead' group
+    index_fname : str
+        json file for the index
+    expected_leads : list
+        lead times that make an init complete (None if each init is a single file)
+    subdirs : bool
+        True if fpath holds one directory per init date (named YYYYMMDDHH) with the files inside
+    
+    '''
+    def __init__(self, fpath, pattern, index_fname, expected_leads=None, subdirs=False):
+        self.fpath = fpath
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.index_fname = index_fname
+        self.expected_leads = None if expected_leads is None else sorted([int(F) for F in expected_leads])
+        self.subdirs = subdirs
+        self.index = {'fpath': fpath, 'pattern': pattern, 'dirs': {}, 'inits': {}, 
+                      'latest': None, 'latest_complete': None, 'expected_leads': self.expected_leads}
+        if os.path.exists(index_fname):
+            try:
+                with open(index_fname, 'r') as f:
+                    index = json.load(f)
+                ## start over if the catalog is for different files
+                if (index['fpath'] == fpath) & (index['pattern'] == pattern):
+                    self.index = index
+            except (ValueError, KeyError):
+                print('...Rebuilding unreadable catalog {0}'.format(index_fname))
+        self.update()
+    
+    def parse_dir(self, path):
+        ## {init: [leads]} for the files in path matching the pattern
+        inits = {}
+        for name in os.listdir(path):
+            m = self.regex.match(name)
+            if m is None:
+                continue
+            lead = int(m.group('lead')) if 'lead' in self.regex.groupindex else None
+            inits.setdefault(m.group('init'), set())
+            if lead is not None:
+                inits[m.group('init')].add(lead)
+        return inits
+    
+    def listed_mtime(self, mtime, scan_time):
+        ## mtime to record for a directory listed at scan_time (None forces a rescan)
+        if mtime >= scan_time - racy_mtime:
+            return None
+        return mtime
+    
+    def is_complete(self, init):
+        if self.expected_leads is None:
+            return init in self.index['inits']
+        return set(self.expected_leads).issubset(self.index['inits'].get(init, []))
+    
+    def update(self):
+        '''
+        Rescans the directories that changed since the last update and saves the index
+        '''
+        dirs = self.index['dirs']
+        inits = self.index['inits']
+        changed = self.index['expected_leads'] != self.expected_leads
+        
+        scan_time = time.time()
+        mtime = os.stat(self.fpath).st_mtime
+        if dirs.get(self.fpath) != mtime:
+            changed = True
+            if self.subdirs:
+                ## the top level only lists init directories, files are read from each one below
+                names = [name for name in os.listdir(self.fpath) if re.fullmatch(r'\d{10}', name)]
+                for init in list(inits):
+                    if init not in names:
+                        del inits[init]
+                        dirs.pop(os.path.join(self.fpath, init), None)
+                for init in names:
+                    inits.setdefault(init, [])
+            else:
+                inits = {init: sorted(leads) for init, leads in self.parse_dir(self.fpath).items()}
+            dirs[self.fpath] = self.listed_mtime(mtime, scan_time)
+        
+        if self.subdirs:
+            ## only init directories that are not complete yet can still change
+            for init in list(inits):
+                if (self.expected_leads is not None) and set(self.expected_leads).issubset(inits[init]):
+                    continue
+                path = os.path.join(self.fpath, init)
+                scan_time = time.time()
+                try:
+                    mtime = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    continue
+                if dirs.get(path) != mtime:
+                    changed = True
+                    inits[init] = sorted(self.parse_dir(path).get(init, []))
+                    dirs[path] = self.listed_mtime(mtime, scan_time)
+        
+        self.index['inits'] = inits
+        if changed:
+            ## init dates sort chronologically as YYYYMMDDHH strings
+            self.index['expected_leads'] = self.expected_leads
+            self.index['latest'] = max(inits) if len(inits) > 0 else None
+            complete = [init for init in inits if self.is_complete(init)]
+            self.index['latest_complete'] = max(complete) if len(complete) > 0 else None
+            self.save()
+    
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_fname)), exist_ok=True)
+        tmp_fname = self.index_fname + '.{0}.tmp'.format(os.getpid())
+        with open(tmp_fname, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_fname, self.index_fname)
+    
+    def latest(self, complete=True):
+        '''
+        Returns the most recent init date (YYYYMMDDHH), only counting inits with
+        every expected lead time if complete is True
+        '''
+        init = self.index['latest_complete'] if complete else self.index['latest']
+        if init is None:
+            raise FileNotFoundError('no {0}forecasts matching {1} in {2}'.format('complete ' if complete else '', self.pattern, self.fpath))
+        return init
+    
+    def leads(self, init):
+        ## lead times found for an init date
+        return self.index['inits'].get(init, [])
+
+def get_forecast_catalog(model, varname, expected_leads=None, index_dir=catalog_dir, year=None):
+    '''
+    Returns the forecast_catalog of the operational files for a model and variable
+
+    Parameters
+    ----------
+    model : str
+        'GEFS' or 'GFS'
+    varname : str
+        'ivt', 'freezing_level' or a GRIB variable in grib_products
+    expected_leads : list
+        lead times that make an init complete (GFS only)
+    index_dir : str
+        directory for the catalog index files
+    year : int
+        year directory of the GFS GRIB files (default: the current year)
+    
+    '''
+    path_to_data = '/data/downloaded/SCRATCH/cw3eit_scratch/'
+    if (model == 'GEFS') & (varname == 'ivt'):
+        fpath, pattern, name, subdirs = path_to_data + 'GEFS/FullFiles/', r'IVT_Full_(?P<init>\d{10})\.nc$', 'GEFS_ivt', False
+    elif (model == 'GEFS') & (varname == 'freezing_level'):
+        fpath, pattern, name, subdirs = path_to_data + 'GEFS/FreezingLevel/', r'FZL_(?P<init>\d{10})\.nc$', 'GEFS_freezing_level', False
+    elif (model == 'GFS') & (varname == 'ivt'):
+        fpath, pattern, name, subdirs = path_to_data + 'GFS/', r'GFS_IVT_(?P<init>\d{10})_F(?P<lead>\d+)\.nc$', 'GFS_ivt', False
+    elif (model == 'GFS') & (varname in grib_products):
+        ## all GRIB variables come from the same files, kept in one directory per year
+        if year is None:
+            year = pd.Timestamp.today().year
+        fpath, pattern, name, subdirs = '/data/downloaded/Forecasts/GFS_025d/{0}/'.format(year), r'gfs_(?P<init>\d{10})_f(?P<lead>\d+)\.grb$', 'GFS_grib_{0}'.format(year), True
+    else:
+        raise ValueError('no forecast catalog for {0} {1}'.format(model, varname))
+    if model == 'GEFS':
+        expected_leads = None
+    
+    return forecast_catalog(fpath, pattern, os.path.join(index_dir, name + '.json'), expected_leads=expected_leads, subdirs=subdirs)
+
 class load_GEFS_datasets:
     '''
     Loads IVT of freezing level from GEFS
@@ -73,7 +351,7 @@ class load_GEFS_datasets:
         xarray dataset object with variables
     
     '''
-    def __init__(self, varname, fdate=None):
+    def __init__(self, varname, fdate=None, min_file_age=60.):
         path_to_data = '/data/downloaded/SCRATCH/cw3eit_scratch/'
         if varname == 'ivt':
             self.fpath = path_to_data + 'GEFS/FullFiles/'
@@ -81,13 +359,8 @@ class load_GEFS_datasets:
             self.fpath = path_to_data + 'GEFS/FreezingLevel/'
         
         if fdate is None:          
-            ## find the most recent file in the currect directory
-            list_of_files = glob.glob(self.fpath+'*.nc')
-            self.fname = max(list_of_files, key=os.path.getctime)
-            
-            # pull the initialization date from the filename
-            regex = re.compile(r'\d+')
-            self.date_string = regex.findall(self.fname)[1]
+            ## find the most recent forecast from the catalog of the current directory
+            self.date_string = get_forecast_catalog('GEFS', varname).latest()
 
         if fdate is not None:
             self.date_string = fdate
@@ -100,10 +373,15 @@ class load_GEFS_datasets:
         self.varname = varname
         self.ensemble_name = 'GEFS'
         self.datasize_min = 15.
+        self.min_file_age = min_file_age
         self.model_init_date = datetime.datetime.strptime(self.date_string, '%Y%m%d%H')
+        # the forecast hours available on mclimate files
+        self.step_lst = [  6,  12,  18,  24,  30,  36,  42,  48,  54,  60,  66,  72,  78,
+                84,  90,  96, 102, 108, 114, 120, 126, 132, 138, 144, 150, 156,
+               162, 168]
 
-    def calc_vars(self):
-        ## load the forecast data
+    def open_forecast(self):
+        ## open the forecast data lazily (nothing is read yet) and subset to SEAK domain
         ds = xr.open_dataset(self.fname)
         
         if self.varname == 'ivt':
@@ -114,32 +392,74 @@ class load_GEFS_datasets:
             ds = ds.rename({'HGT_P1_L4_GLL0': 'freezing_level', 'forecast_time0': 'step', 'lat_0': 'lat', 'lon_0': 'lon', 'ensemble0': 'ensemble'}) # need to rename this to match GEFSv12 Reforecast
             ds = ds.assign_coords({"init_date": (self.model_init_date)})
         
-        ## modifications to file regardless of variable
-        ds = ds.assign_coords({"lon": (((ds.lon + 180) % 360) - 180)}) # Convert DataArray longitude coordinates from 0-359 to -180-179
-        ds = ds.sel(lon=slice(-179.5, -110.), lat=slice(10., 70.)) ## subset to SEAK domain
-        # the forecast hours available on mclimate files
-        step = np.array([  6,  12,  18,  24,  30,  36,  42,  48,  54,  60,  66,  72,  78,
-                84,  90,  96, 102, 108, 114, 120, 126, 132, 138, 144, 150, 156,
-               162, 168])
+        ds = subset_domain(ds) ## subset to SEAK domain
+        return ds
 
+    def step_ready(self, step):
+        ## GEFS forecast hours are all in one file, so a step is ready once the file is complete
+        if os.path.exists(self.fname) == False:
+            return False
+        return (time.time() - os.path.getmtime(self.fname)) >= self.min_file_age
+
+    @instrument.timed()
+    def read_step(self, step, member_chunk=5):
+        ## read the ensemble mean of a single forecast hour
+        ds = self.open_forecast()
+        ds = ds.sel(step=[step])
+        ds = ds.assign_coords({"step": [int(step)]})
+        ds = ds.chunk({'ensemble': member_chunk}).mean('ensemble')
+        return ds.load()
+
+    @instrument.timed()
+    def calc_vars(self, member_chunk=5, ensemble_mean=True):
+        '''
+        Reads the ensemble mean forecast for the SEAK domain and mclimate forecast hours
+        
+        The file is opened lazily and the step selection and lat/lon window are applied
+        before any data is read. The ensemble mean is computed over chunks of 
+        member_chunk members, so the full member x step x lat x lon array is never in memory.
+        If ensemble_mean is False, the members are returned as a lazy (dask) dataset.
+        '''
+        ds = self.open_forecast()
+        step = np.array(self.step_lst)
         ds = ds.sel(step=step) # select the forecast hour steps we are interested in
         ds = ds.assign_coords({"step": (step.astype(int))}) # swap step to int
-        ds = ds.mean('ensemble') # create ensemble mean
+        
+        ds = ds.chunk({'ensemble': member_chunk})
+        if ensemble_mean == False:
+            return ds
+        
+        ## create ensemble mean as a reduction over chunks of members
+        ds = ds.mean('ensemble')
+        ds = ds.load()
 
         return ds
     
     
 class load_GFS_datasets:
     '''
-    Loads IVT from GFS
+    Loads IVT or freezing level from GFS
     
     Parameters
     ----------
     varname : str
-        variable name for forecast to compare to mclimate. 'ivt' or 'freezing_level' are acceptable
+        variable name for forecast to compare to mclimate. 'ivt' or any GRIB variable 
+        in grib_products ('freezing_level', 'uv1000') are acceptable
         
-    fname : str
-        filename you want to specify - otherwise it will use the latest IVT file from GEFS
+    fdate : str
+        initialization date (YYYYMMDDHH) - otherwise it will use the latest GFS files
+        
+    nthreads : int
+        number of forecast hour files read at once
+        
+    min_file_age : float
+        files modified less than this many seconds ago are treated as still being written
+        
+    index_dir : str
+        directory for the persistent GRIB message indexes
+        
+    complete : bool
+        if fdate is None, use the latest init with every forecast hour (False uses the latest init)
   
     Returns
     -------
@@ -147,8 +467,12 @@ class load_GFS_datasets:
         xarray dataset object with variables
     
     '''
-    def __init__(self, varname, fdate=None):
+    def __init__(self, varname, fdate=None, nthreads=8, min_file_age=60., index_dir=grib_index_dir, complete=True):
         self.varname = varname
+        self.nthreads = nthreads
+        self.min_file_age = min_file_age
+        self.index_dir = index_dir
+        self.dvar = 'uv' if varname == 'uv1000' else varname # variable name in the dataset
         
         self.F_lst = [  6,  12,  18,  24,  30,  36,  42,  48,  54,  60,  66,  72,
                  78, 84,  90,  96, 102, 108, 114, 120, 126, 132, 138, 144, 150,
@@ -160,13 +484,8 @@ class load_GFS_datasets:
             self.fpath = path_to_data + 'GFS/'
 
             if fdate is None:
-                ## find the most recent file in the currect directory
-                list_of_files = glob.glob(self.fpath+'*.nc')
-                self.fname = max(list_of_files, key=os.path.getctime)
-
-                # pull the initialization date from the filename
-                regex = re.compile(r'\d+')
-                self.date_string = regex.findall(self.fname)[1]
+                ## find the most recent forecast from the catalog of the current directory
+                self.date_string = get_forecast_catalog('GFS', varname, expected_leads=self.F_lst).latest(complete)
                 
             elif fdate is not None:
                 self.date_string = fdate
@@ -178,63 +497,113 @@ class load_GFS_datasets:
             self.fname_lst = fname_lst
 
 
-        elif varname == 'freezing_level':
+        elif varname in grib_products:
 
-            year = pd.Timestamp.today().year
-            path_to_data = '/data/downloaded/Forecasts/GFS_025d/{0}/*'.format(year)
             if fdate is None:
-                list_of_files = glob.glob(path_to_data)
-                self.fpath = max(list_of_files, key=os.path.getctime)
-                regex = re.compile(r'\d+')
-                self.date_string = regex.findall(self.fpath)[-1]
+                ## an init from the end of last year can still be the latest just after the new year
+                inits = []
+                this_year = pd.Timestamp.today().year
+                for year in [this_year, this_year - 1]:
+                    try:
+                        inits.append(get_forecast_catalog('GFS', varname, expected_leads=self.F_lst, year=year).latest(complete))
+                    except FileNotFoundError:
+                        pass
+                if len(inits) == 0:
+                    raise FileNotFoundError('no {0}GFS GRIB forecasts for {1} or {2}'.format('complete ' if complete else '', this_year, this_year - 1))
+                self.date_string = max(inits)
             elif fdate is not None:
                 self.date_string = fdate
-                self.fpath = '/data/downloaded/Forecasts/GFS_025d/{0}/{1}'.format(year, self.date_string)
+            evict_grib_indexes(index_dir)
+            ## the year directory comes from the init date, not the current date
+            self.fpath = '/data/downloaded/Forecasts/GFS_025d/{0}/{1}'.format(self.date_string[:4], self.date_string)
+            ## read the GRIB files in place
             fname_lst = []
             for i, F in enumerate(self.F_lst):
                 fname = '/gfs_{0}_f{1}.grb'.format(self.date_string, str(F).zfill(3))
-
-                ## for now: copy the files to local space
-                repo_path = '/home/dnash/comet_data/tmp'
-                shutil.copy(self.fpath+fname, repo_path+fname) # copy file over to data folder
-                fname_lst.append(repo_path+fname)      
+                fname_lst.append(self.fpath+fname)      
             self.fname_lst = fname_lst
 
         self.model_init_date = datetime.datetime.strptime(self.date_string, '%Y%m%d%H')
+        self.step_lst = self.F_lst
 
-    def calc_vars(self):
+    def file_status(self, fname):
+        ## 'missing', 'incomplete' (still being written) or 'ready'
+        if os.path.exists(fname) == False:
+            return 'missing'
+        st = os.stat(fname)
+        if (st.st_size == 0) | ((time.time() - st.st_mtime) < self.min_file_age):
+            return 'incomplete'
+        return 'ready'
+
+    def check_files(self):
+        '''
+        Returns lists of forecast hour files that are missing or still being written
+        '''
+        status = [self.file_status(fname) for fname in self.fname_lst]
+        missing = [fname for fname, s in zip(self.fname_lst, status) if s == 'missing']
+        incomplete = [fname for fname, s in zip(self.fname_lst, status) if s == 'incomplete']
+        return missing, incomplete
+
+    def step_ready(self, step):
+        return self.file_status(self.fname_lst[self.F_lst.index(step)]) == 'ready'
+
+    @instrument.timed()
+    def read_step(self, step):
+        ## read a single forecast hour
+        vals, lats, lons = self.read_file(self.fname_lst[self.F_lst.index(step)])
+        var_dict = {self.dvar: (['step', 'lat', 'lon'], vals[np.newaxis])}
+        ds = xr.Dataset(var_dict,
+                        coords={'step': (['step'], [step]),
+                                'lat': (['lat'], lats),
+                                'lon': (['lon'], lons)})
+        ds = ds.assign_coords({"init_date": (self.model_init_date)})
+        return ds
+
+    def read_file(self, fname):
+        ## read a single forecast hour file and subset to SEAK domain
         if self.varname == 'ivt':
-            ## open the files with the correct forecast hour
-            ds_lst = []
-            for i, fname in enumerate(self.fname_lst):
-                ds = xr.open_dataset(fname)
-                ds = ds.rename({'lon_0': 'lon', 'lat_0': 'lat'}) # need to rename this to match GEFS
-                ds_lst.append(ds)
-
-            ## concat the dataset list into a single dataset
-            ds = xr.concat(ds_lst, pd.Index(self.F_lst, name="step"))
-            ## clean dataset
-            ds = ds.rename({'IVT': 'ivt'}) # need to rename this to match GEFSv12 Reforecast
-            ds = ds.drop_vars(["uIVT", "vIVT"])
-            ds = ds.assign_coords({"init_date": (self.model_init_date)})
-            ds = ds.assign_coords({"lon": (((ds.lon + 180) % 360) - 180)}) # Convert DataArray longitude coordinates from 0-359 to -180-179
-            ds = ds.sel(lon=slice(-179.5, -110.), lat=slice(10., 70.)) ## subset to SEAK domain
-            
-            
-        if self.varname == 'freezing_level':
-            ## open the files with the correct forecast hour
-            ds_lst = []
-            for i, fname in enumerate(self.fname_lst):
-                ds = xr.open_dataset(fname, engine='cfgrib', filter_by_keys={'typeOfLevel': 'isothermZero'})
-                ds = ds.rename({'longitude': 'lon', 'latitude': 'lat', 'time': 'init_date',
-                                'gh': 'freezing_level'}) # need to rename this to match GEFS
-                ds_lst.append(ds)
-
-            ## concat the dataset list into a single dataset
-            ds = xr.concat(ds_lst, dim="step")
-            ds = ds.drop_vars(["r"])
-            ds = ds.assign_coords({"step": (self.F_lst)})
-            ds = ds.assign_coords({"lon": (((ds.lon + 180) % 360) - 180)}) # Convert DataArray longitude coordinates from 0-359 to -180-179
-            ds = ds.sel(lon=slice(-179.5, -110.), lat=slice(70., 10.)) ## subset to SEAK domain
-
-        return ds
\ No newline at end of file
+            ds = xr.open_dataset(fname)
+            ds = ds.rename({'lon_0': 'lon', 'lat_0': 'lat', 'IVT': 'ivt'}) # need to rename this to match GEFS
+        elif self.varname in grib_products:
+            ## decode only the messages for this variable (e.g., isothermZero geopotential height)
+            ds = open_grib_variable(fname, self.varname, self.index_dir) 
+        ds = subset_domain(ds)
+        da = ds[self.dvar].transpose('lat', 'lon')
+        vals = da.values
+        ds.close()
+        return vals, da.lat.values, da.lon.values
+
+    @instrument.timed()
+    def calc_vars(self):
+        ## report forecast hours that are not ready; their steps are left as NaN
+        missing, incomplete = self.check_files()
+        for fname in missing:
+            print('...Missing {0}'.format(fname))
+        for fname in incomplete:
+            print('...Still being written {0}'.format(fname))
+        self.missing = missing
+        self.incomplete = incomplete
+        ready = [(i, fname) for i, fname in enumerate(self.fname_lst) if (fname not in missing) & (fname not in incomplete)]
+        if len(ready) == 0:
+            raise FileNotFoundError('no GFS {0} files are ready for {1}'.format(self.varname, self.date_string))
+        
+        ## read the first file for the grid, then preallocate the step x lat x lon array
+        i, fname = ready[0]
+        vals, lats, lons = self.read_file(fname)
+        data = np.full((len(self.F_lst),) + vals.shape, np.nan, dtype=vals.dtype)
+        data[i] = vals
+        
+        ## read the remaining forecast hours concurrently, filling in each step
+        with ThreadPoolExecutor(max_workers=self.nthreads) as pool:
+            futures = {pool.submit(self.read_file, fname): i for i, fname in ready[1:]}
+            for future in as_completed(futures):
+                data[futures[future]] = future.result()[0]
+
+        var_dict = {self.dvar: (['step', 'lat', 'lon'], data)}
+        ds = xr.Dataset(var_dict,
+                        coords={'step': (['step'], self.F_lst),
+                                'lat': (['lat'], lats),
+                                'lon': (['lon'], lons)})
+        ds = ds.assign_coords({"init_date": (self.model_init_date)})
+
+        return ds
@@ -0,0 +1,198 @@
+"""
+Filename:    instrument.py
+Author:      Deanna Nash, dnash@ucsd.edu
+Description: Opt-in stage timing (wall, CPU, peak RSS, bytes read) for the M-Climate tool, with a profiler hook
+"""
+
+import os, sys
+import json
+import time
+import threading
+import resource
+import cProfile
+import functools
+import contextlib
+import numpy as np
+import pandas as pd
+
+## nothing is measured unless enable() is called
+enabled = False
+records = []
+run_info = {}
+thread_state = threading.local() # each thread has its own stack of open stages
+profile_stages = set()
+profile_dir = None
+profiler_factory = None
+
+def enable(stages_to_profile=[], out_dir=None, factory=None):
+    '''
+    Turns on stage records for this process (and processes forked from it)
+
+    Parameters
+    ----------
+    stages_to_profile : list
+        stage names to run under a profiler, e.g., ['compare_mclimate_to_forecast']
+    out_dir : str
+        directory for the profiler output (default: current directory)
+    factory : callable
+        factory(name, out_dir) returning a context manager that profiles the stage,
+        e.g., to attach a sampling profiler (default: cprofile_stage)
+    '''
+    global enabled, profile_stages, profile_dir, profiler_factory
+    enabled = True
+    profile_stages = set(stages_to_profile)
+    profile_dir = out_dir
+    profiler_factory = cprofile_stage if factory is None else factory
+    new_run()
+
+def new_run():
+    ## start a new record (e.g., for each forecast processed by a long-running process)
+    del records[:]
+    run_info.update({'start': pd.Timestamp.now().isoformat(), 'argv': sys.argv, 'pid': os.getpid(),
+                     'start_wall': time.perf_counter()})
+    reset_peak_rss()
+
+@contextlib.contextmanager
+def cprofile_stage(name, out_dir):
+    ## default profiler hook, writes {name}_{pid}.prof (read with pstats or snakeviz)
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        out_dir = '.' if out_dir is None else out_dir
+        os.makedirs(out_dir, exist_ok=True)
+        prof.dump_stats(os.path.join(out_dir, '{0}_{1}.prof'.format(name, os.getpid())))
+
+def read_io():
+    ## bytes read by this process (all threads); None where /proc/self/io is not readable
+    try:
+        with open('/proc/self/io', 'r') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return {'rchar': int(io['rchar']), 'read_bytes': int(io['read_bytes'])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+def read_rss():
+    ## current and peak (since the last reset) resident set size in MB
+    try:
+        with open('/proc/self/status', 'r') as f:
+            status = dict(line.split(':', 1) for line in f.read().splitlines() if ':' in line)
+        return int(status['VmRSS'].split()[0])/1e3, int(status['VmHWM'].split()[0])/1e3
+    except (OSError, KeyError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3
+        return rss, rss
+
+def reset_peak_rss():
+    ## resets VmHWM so the peak of each stage can be read (Linux); returns False if not allowed
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def snapshot():
+    rss, peak = read_rss()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'wall': time.perf_counter(), 'cpu': time.process_time(),
+            'cpu_children': children.ru_utime + children.ru_stime,
+            'rss_mb': rss, 'peak_rss_mb': peak, 'io': read_io()}
+
+def get_stack():
+    ## stages open in this thread
+    if hasattr(thread_state, 'stack') == False:
+        thread_state.stack = []
+    return thread_state.stack
+
+def simple_args(args, kwargs):
+    ## keep the str/number arguments so records can be told apart (e.g., varname and step)
+    simple = (str, int, float, bool, np.integer, np.floating)
+    info = {'arg{0}'.format(i): arg for i, arg in enumerate(args) if isinstance(arg, simple)}
+    info.update({key: val for key, val in kwargs.items() if isinstance(val, simple)})
+    return {key: (val.item() if isinstance(val, np.generic) else val) for key, val in info.items()}
+
+@contextlib.contextmanager
+def stage(name, **info):
+    '''
+    Records wall time, CPU time (this process and reaped child processes),
+    peak RSS and bytes read for the enclosed block
+    
+    CPU time, peak RSS and bytes read are per process. Stages on other threads than the 
+    main thread do not reset the peak, so their peak_rss_mb is the process peak since the 
+    last reset (marked with peak_scope='process').
+    '''
+    if enabled == False:
+        yield
+        return
+    stack = get_stack()
+    main_thread = threading.current_thread() is threading.main_thread()
+    ## the enclosing stage keeps the peak it has seen before it is reset for this stage
+    if len(stack) > 0:
+        stack[-1]['seen_peak'] = max(stack[-1]['seen_peak'], read_rss()[1])
+    if main_thread:
+        reset_peak_rss()
+    frame = {'name': name, 'seen_peak': 0., 'start': snapshot()}
+    stack.append(frame)
+    profiler = profiler_factory(name, profile_dir) if name in profile_stages else contextlib.nullcontext()
+    error = None
+    try:
+        with profiler:
+            yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        end = snapshot()
+        stack.pop()
+        start = frame['start']
+        peak = max(end['peak_rss_mb'], frame['seen_peak'])
+        rec = {'stage': name, 'parent': stack[-1]['name'] if len(stack) > 0 else None, 'pid': os.getpid(),
+               'wall_s': end['wall'] - start['wall'], 'cpu_s': end['cpu'] - start['cpu'],
+               'cpu_children_s': end['cpu_children'] - start['cpu_children'],
+               'rss_start_mb': start['rss_mb'], 'rss_end_mb': end['rss_mb'], 'peak_rss_mb': peak}
+        if (start['io'] is not None) and (end['io'] is not None):
+            rec['rchar'] = end['io']['rchar'] - start['io']['rchar']
+            rec['read_bytes'] = end['io']['read_bytes'] - start['io']['read_bytes']
+        if main_thread == False:
+            rec['thread'] = threading.current_thread().name
+            rec['peak_scope'] = 'process'
+        if error is not None:
+            rec['error'] = error
+        rec.update(info)
+        records.append(rec)
+        if len(stack) > 0:
+            stack[-1]['seen_peak'] = max(stack[-1]['seen_peak'], peak)
+
+def timed(name=None):
+    '''
+    Decorator that runs the function as an instrumented stage (does nothing unless enabled)
+    '''
+    def decorator(func):
+        stage_name = func.__qualname__ if name is None else name
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if enabled == False:
+                return func(*args, **kwargs)
+            with stage(stage_name, **simple_args(args, kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def write_record(out_dir, **info):
+    '''
+    Writes the records of this run to {out_dir}/run_{start time}_{pid}.json
+    '''
+    if enabled == False:
+        return None
+    os.makedirs(out_dir, exist_ok=True)
+    rec = {key: val for key, val in run_info.items() if key != 'start_wall'}
+    rec['wall_s'] = time.perf_counter() - run_info['start_wall']
+    rec['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3
+    rec.update(info)
+    rec['stages'] = records
+    fname = os.path.join(out_dir, 'run_{0}_{1}.json'.format(pd.Timestamp(run_info['start']).strftime('%Y%m%d%H%M%S'), os.getpid()))
+    with open(fname, 'w') as f:
+        json.dump(rec, f, indent=1, default=str)
+    return fname
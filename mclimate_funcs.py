@@ -5,79 +5,660 @@ Description: Functions for comparing GEFSv12 mClimate to GEFSv12 reforecast
 """
 
 import os, sys
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 import xarray as xr
 import numpy as np
 import pandas as pd
 
 import cw3e_tools as ctools
+import regrid_funcs as regrid
+import instrument
 
-def compare_mclimate_to_forecast(fc, mclimate, varname):
+## quantiles stored in the mclimate files
+quant_lst = [0.  , 0.75, 0.9 , 0.91, 0.92, 0.93, 0.94, 0.95, 0.96, 0.97, 0.98, 0.99, 1.  ]
+## integer bin code for grid cells that do not fall in any mclimate bin
+missing_code = 255
+
+def percentile_bin_codes(fc_vals, q_vals):
+    '''
+    Bin forecast values against the mclimate quantile surfaces in a single vectorized pass
+    
+    Parameters
+    ----------
+    fc_vals : array (..., step, lat, lon)
+        forecast values; leading dimensions (e.g., ensemble) are broadcast
+    q_vals : array (quantile, step, lat, lon)
+        mclimate quantile surfaces, sorted along the first axis
+  
+    Returns
+    -------
+    codes : uint8 array (..., step, lat, lon)
+        index into quant_lst of the bin the forecast falls in, or missing_code
+        where the forecast equals a threshold, falls between the 0th and 75th percentile,
+        or is NaN
+    
+    '''
+    nquantiles = q_vals.shape[0]
+    q_vals = np.expand_dims(q_vals, axis=tuple(range(1, fc_vals.ndim - q_vals.ndim + 2)))
+    ## number of quantile surfaces strictly below and at or below the forecast
+    n_lt = np.count_nonzero(q_vals < fc_vals, axis=0)
+    n_le = np.count_nonzero(q_vals <= fc_vals, axis=0)
+    
+    codes = np.full(n_lt.shape, missing_code, dtype=np.uint8)
+    ## below the minimum quantile
+    codes[n_le == 0] = 0
+    ## between two quantiles (n_lt - 1 is the index of the bottom quantile)
+    idx = (n_lt == n_le) & (n_lt > 1) & (n_lt < nquantiles)
+    codes[idx] = n_lt[idx] - 1
+    ## above the maximum quantile
+    codes[n_lt == nquantiles] = nquantiles - 1
+    ## NaN forecast or mclimate values compare as False above
+    invalid = np.isnan(fc_vals) | np.isnan(q_vals).any(axis=0)
+    codes[invalid] = missing_code
+
+    return codes
+
+def decode_percentile_bins(codes):
+    '''
+    Convert integer bin codes from percentile_bin_codes to quantile values (NaN for missing_code)
+    '''
+    lut = np.full(256, np.nan)
+    lut[:len(quant_lst)] = quant_lst
+    return lut[codes]
+
+def encode_percentile_bins(vals):
+    '''
+    Convert quantile values (e.g., the 'mclimate' output of compare_mclimate_to_forecast) 
+    back to integer bin codes (missing_code for NaN)
+    '''
+    codes = np.full(vals.shape, missing_code, dtype=np.uint8)
+    valid = ~np.isnan(vals)
+    codes[valid] = np.searchsorted(quant_lst, np.round(vals[valid], 6))
+    return codes
+
+def code_attrs(mode='discrete'):
+    ## attributes of a uint8 'mclimate' variable: the lookup table from code to quantile
+    return {'mode': mode, 'quantiles': list(quant_lst), 'missing_code': missing_code,
+            'description': 'index into quantiles of the mclimate bin of the forecast, missing_code where undefined'}
+
+def percentile_rank_continuous(fc_vals, q_vals):
+    '''
+    Continuous percentile rank of the forecast, linearly interpolated between 
+    the neighboring mclimate quantile surfaces in a single vectorized pass
+    
+    Parameters
+    ----------
+    fc_vals : array (..., step, lat, lon)
+        forecast values; leading dimensions (e.g., ensemble) are broadcast
+    q_vals : array (quantile, step, lat, lon)
+        mclimate quantile surfaces, sorted along the first axis
+  
+    Returns
+    -------
+    rank : float array (..., step, lat, lon)
+        percentile rank between 0 and 1 (0 below the minimum, 1 above the maximum quantile)
+    
+    '''
+    nquantiles = q_vals.shape[0]
+    quants = np.asarray(quant_lst)
+    q_vals = np.expand_dims(q_vals, axis=tuple(range(1, fc_vals.ndim - q_vals.ndim + 2)))
+    ## index of the top of the quantile interval the forecast falls in
+    n_lt = np.count_nonzero(q_vals < fc_vals, axis=0)
+    k = np.clip(n_lt, 1, nquantiles-1)
+    q_lo = np.take_along_axis(q_vals, k[np.newaxis]-1, axis=0)[0]
+    q_hi = np.take_along_axis(q_vals, k[np.newaxis], axis=0)[0]
+    
+    ## fractional position within the interval
+    width = q_hi - q_lo
+    frac = np.divide(fc_vals - q_lo, width, out=np.zeros(width.shape), where=width > 0)
+    frac = np.clip(frac, 0., 1.)
+    rank = quants[k-1] + frac*(quants[k] - quants[k-1])
+    
+    ## NaN forecast or mclimate values
+    invalid = np.isnan(fc_vals) | np.isnan(q_vals).any(axis=0)
+    rank[invalid] = np.nan
+
+    return rank
+
+@instrument.timed()
+def compare_mclimate_to_forecast(fc, mclimate, varname, codes=False, mode='discrete'):
+    '''
+    Compare forecast to mclimate and return the mclimate percentile rank of each grid cell
+    
+    Parameters
+    ----------
+    fc : xarray dataset
+        forecast with dimensions (step, lat, lon)
+    mclimate : xarray dataset
+        mclimate with dimensions (quantile, step, lat, lon)
+    varname : str
+        'ivt', 'freezing_level' or 'uv1000'
+    codes : bool
+        if True, return uint8 bin codes (index into quant_lst, missing_code where undefined)
+        instead of quantile values (mode='discrete' only)
+    mode : str
+        'discrete' snaps each grid cell to the quantile bin it falls in (see quant_lst);
+        'continuous' interpolates the percentile rank between neighboring quantile surfaces
+  
+    Returns
+    -------
+    ds : xarray dataset
+        dataset with 'mclimate' variable (step, lat, lon)
+    
+    '''
     if varname == 'uv1000':
         varname = 'uv'
-    ## compare IVT forecast to mclimate
-    b_lst = []
-    quant_lst = [0.  , 0.75, 0.9 , 0.91, 0.92, 0.93, 0.94, 0.95, 0.96, 0.97, 0.98, 0.99, 1.  ]
-    nquantiles = len(quant_lst)
-    for i, quant in enumerate(range(nquantiles)):
-        bottom = mclimate[varname].isel(quantile=quant) # minimum threshold
-        
-        if i == 0:
-            # only need to see where variable in the forecast is less than minimum quantile
-            b = xr.where(cond=fc[varname] < bottom, x=quant_lst[i], y=np.nan)          
-            
-        elif (i > 0) & (i < nquantiles-1):
-            # where IVT in the forecast is greater than current quartile, but less than next quartile
-            top = mclimate[varname].isel(quantile=i+1)
-            b = xr.where(cond=(fc[varname] > bottom) & (fc[varname] < top), x=quant_lst[i], y=np.nan)
-            b = b.assign_coords({'quantile': (quant_lst[i])})
-            
-        elif (i == nquantiles-1):
-            # where variable is greater than final quartile
-            b = xr.where(cond=(fc[varname] > bottom), x=quant_lst[i], y=np.nan)
-            b = b.expand_dims(dim="quantile")
-    
-        b.name = varname
-        var_dict = {'mclimate': (['step', 'lat', 'lon'], b.squeeze().values)}
-        new_ds = xr.Dataset(var_dict,
-                        coords={'lat': (['lat'], b.lat.values),
-                                'lon': (['lon'], b.lon.values),
-                                'step': (['step'], b.step.values)})     
-        b_lst.append(new_ds)
-        
-    ds = xr.merge(b_lst)
+    if mode not in ('discrete', 'continuous'):
+        raise ValueError("mode must be 'discrete' or 'continuous', got {0}".format(mode))
+    if codes & (mode == 'continuous'):
+        raise ValueError("integer bin codes are only available for mode='discrete'")
+    ## align forecast and mclimate to their common steps and grid points
+    fc_da, mclim_da = xr.align(fc[varname], mclimate[varname], join='inner')
+    fc_da = fc_da.transpose('step', 'lat', 'lon')
+    mclim_da = mclim_da.transpose('quantile', 'step', 'lat', 'lon')
+    
+    ## compare forecast to mclimate
+    if mode == 'continuous':
+        b = percentile_rank_continuous(fc_da.values, mclim_da.values)
+    else:
+        b = percentile_bin_codes(fc_da.values, mclim_da.values)
+        if codes == False:
+            b = decode_percentile_bins(b)
+    
+    attrs = code_attrs(mode) if codes else {'mode': mode}
+    var_dict = {'mclimate': (['step', 'lat', 'lon'], b, attrs)}
+    ds = xr.Dataset(var_dict,
+                    coords={'lat': (['lat'], fc_da.lat.values),
+                            'lon': (['lon'], fc_da.lon.values),
+                            'step': (['step'], fc_da.step.values)})
     ds = ds.assign_coords({"init_date": (fc.init_date)})
 
     return ds
 
-def load_reforecast(date, varname):
-    path_to_data = '/expanse/nfs/cw3e/cwp140/' 
-    fname_pattern = path_to_data + 'preprocessed/GEFSv12_reforecast/{0}/{1}_{0}_F*.nc'.format(varname, date)
-    forecast = xr.open_mfdataset(fname_pattern, engine='netcdf4', concat_dim="step", combine='nested')
+@instrument.timed()
+def compare_mclimate_to_ensemble(fc, mclimate, varname, exceed_quant=[0.9, 0.95, 0.99], member_dim='ensemble', member_chunk=5, mode='discrete'):
+    '''
+    Compare each ensemble member to mclimate
+    
+    The percentile rank of every member and the fraction of members above the selected
+    quantiles are computed with one broadcast over the member axis for each chunk of 
+    member_chunk members, so memory is bounded by the chunk size.
+    
+    Parameters
+    ----------
+    fc : xarray dataset
+        forecast with dimensions (member_dim, step, lat, lon), may be lazy (dask)
+    mclimate : xarray dataset
+        mclimate with dimensions (quantile, step, lat, lon)
+    varname : str
+        'ivt', 'freezing_level' or 'uv1000'
+    exceed_quant : list
+        mclimate quantiles to compute the fraction of members above
+    member_dim : str
+        name of the ensemble member dimension ('ensemble' for GEFS, 'number' for the reforecast)
+    member_chunk : int
+        number of members compared at once
+    mode : str
+        'discrete' or 'continuous' percentile rank (see compare_mclimate_to_forecast)
+  
+    Returns
+    -------
+    ds : xarray dataset
+        dataset with 'mclimate' (member_dim, step, lat, lon) percentile rank of each member
+        and 'exceedance' (threshold, step, lat, lon) fraction of members above each quantile
+    
+    '''
+    if varname == 'uv1000':
+        varname = 'uv'
+    if mode not in ('discrete', 'continuous'):
+        raise ValueError("mode must be 'discrete' or 'continuous', got {0}".format(mode))
+    ## align forecast and mclimate to their common steps and grid points
+    fc_da, mclim_da = xr.align(fc[varname], mclimate[varname], join='inner')
+    fc_da = fc_da.transpose(member_dim, 'step', 'lat', 'lon')
+    mclim_da = mclim_da.transpose('quantile', 'step', 'lat', 'lon')
+    q_vals = mclim_da.values
+    
+    ## quantile surfaces for the exceedance probabilities
+    iquant = [int(np.argmin(np.abs(np.asarray(quant_lst) - q))) for q in exceed_quant]
+    q_exceed = q_vals[iquant][:, np.newaxis] # (threshold, 1, step, lat, lon)
+
+    nmembers = fc_da.sizes[member_dim]
+    if mode == 'continuous':
+        rank = np.empty(fc_da.shape, dtype=np.float32)
+    else:
+        rank = np.empty(fc_da.shape, dtype=np.uint8)
+    n_above = np.zeros((len(exceed_quant),) + fc_da.shape[1:], dtype=np.int32)
+    n_valid = np.zeros(fc_da.shape[1:], dtype=np.int32)
+    for i in range(0, nmembers, member_chunk):
+        vals = fc_da.isel({member_dim: slice(i, i+member_chunk)}).values
+        if mode == 'continuous':
+            rank[i:i+member_chunk] = percentile_rank_continuous(vals, q_vals)
+        else:
+            rank[i:i+member_chunk] = percentile_bin_codes(vals, q_vals)
+        n_above += np.count_nonzero(vals[np.newaxis] > q_exceed, axis=1)
+        n_valid += np.count_nonzero(~np.isnan(vals), axis=0)
+    
+    if mode == 'discrete':
+        rank = decode_percentile_bins(rank)
+    exceedance = np.divide(n_above, n_valid, out=np.full(n_above.shape, np.nan), where=n_valid > 0)
+    
+    var_dict = {'mclimate': ([member_dim, 'step', 'lat', 'lon'], rank, {'mode': mode}),
+                'exceedance': (['threshold', 'step', 'lat', 'lon'], exceedance)}
+    ds = xr.Dataset(var_dict,
+                    coords={'lat': (['lat'], fc_da.lat.values),
+                            'lon': (['lon'], fc_da.lon.values),
+                            'step': (['step'], fc_da.step.values),
+                            'threshold': (['threshold'], [quant_lst[i] for i in iquant])})
+    if member_dim in fc_da.coords:
+        ds = ds.assign_coords({member_dim: fc_da[member_dim].values})
+    ds = ds.assign_coords({"init_date": (fc.init_date)})
+
+    return ds
+
+## preprocessed GEFSv12 reforecast, one file per variable, initialization date and lead time
+reforecast_path = '/expanse/nfs/cw3e/cwp140/preprocessed/GEFSv12_reforecast/'
+## {varname: {date: {lead: fname}}} from one listing of each reforecast directory
+reforecast_listing = {}
+
+def list_reforecast(varname, refresh=False):
+    ## lists the reforecast directory of varname once and reuses it (refresh lists it again)
+    if refresh or (varname not in reforecast_listing):
+        pattern = re.compile(r'^(\d{{8,10}})_{0}_F(\d+)\.nc$'.format(varname))
+        listing = {}
+        for fname in os.listdir(reforecast_path + varname):
+            match = pattern.match(fname)
+            if match is not None:
+                listing.setdefault(match.group(1), {})[int(match.group(2))] = reforecast_path + '{0}/{1}'.format(varname, fname)
+        reforecast_listing[varname] = listing
+    return reforecast_listing[varname]
+
+def reforecast_fnames(date, varname):
+    '''
+    Lead-time files of one reforecast every 6 hours up to 10 days lead time, 
+    found from the directory listing without opening them
+    
+    Returns
+    -------
+    fnames : dict
+        {lead (from the _F### part of the filename): fname}
+    '''
+    leads = list_reforecast(varname).get(date, {})
+    return {lead: leads[lead] for lead in sorted(leads) if (lead > 0) & (lead % 6 == 0)} ## the files are 3-hourly, keep every 6 hours
+
+def open_reforecast(date, varname, steps=None, ext=None):
+    '''
+    Lazy (dask) reforecast of every member (number, step, lat, lon), every 6 hours up to 10 days lead time
+    
+    Only the lead-time files that are needed are opened (in parallel), and the lat/lon window 
+    is applied to each file before they are combined.
+    
+    Parameters
+    ----------
+    date : str
+        initialization date as in the reforecast filenames
+    varname : str
+        'ivt', 'freezing_level' or 'uv1000'
+    steps : list
+        lead times (h) to open (None opens every 6-hourly lead time)
+    ext : list
+        [minlon, maxlon, minlat, maxlat] window (None keeps the full grid)
+    '''
+    fnames = reforecast_fnames(date, varname)
+    if steps is not None:
+        fnames = {lead: fnames[lead] for lead in steps if lead in fnames}
+    if len(fnames) == 0:
+        raise FileNotFoundError('no {0} reforecast files for {1}'.format(varname, date))
+    
+    def preprocess(ds):
+        if (varname == 'ivt') | (varname == 'uv1000'):
+            ds = ds.rename({'longitude': 'lon', 'latitude': 'lat'}) # need to rename this to match GEFSv12 Reforecast mclimate
+        if ext is not None:
+            ds = subset_to_domain(ds, ext)
+        return ds
+    
+    forecast = xr.open_mfdataset([fnames[lead] for lead in sorted(fnames)], engine='netcdf4', concat_dim="step", combine='nested',
+                                 preprocess=preprocess, parallel=True)
     forecast  = forecast.sortby("step") # sort by step (forecast lead)
-    tmp = forecast.step[1::2].values
-    forecast = forecast.sel(step=tmp) ## select every 6 hours up to 10 days lead time
     step_vals = forecast.step.values / pd.Timedelta(hours=1)
     forecast = forecast.assign_coords({"step": step_vals.astype(int)})
     if varname == 'ivt':
-        forecast = forecast.rename({'longitude': 'lon', 'latitude': 'lat', 'time': 'init_date'}) # need to rename this to match GEFSv12 Reforecast mclimate
+        forecast = forecast.rename({'time': 'init_date'})
         forecast = forecast.drop_vars(["ivtu", "ivtv"])
     elif varname == 'uv1000':
-        forecast = forecast.rename({'longitude': 'lon', 'latitude': 'lat'}) # need to rename this to match GEFSv12 Reforecast
-        uv = np.sqrt(forecast.u**2 + forecast.v**2)
-        forecast = forecast.assign(uv=(['number', 'step', 'lat','lon'],uv.data))
+        forecast = forecast.assign(uv=np.sqrt(forecast.u**2 + forecast.v**2))
         forecast = forecast.drop_vars(["u", "v"])
         forecast = forecast.assign_coords(init_date=(pd.to_datetime(date)))
     else:
         forecast = forecast.assign_coords(init_date=(pd.to_datetime(date)))
-        
     
-    forecast = forecast.sel(lon=slice(-179.5, -110.), lat=slice(70., 10.))
+    return forecast
+
+@instrument.timed()
+def load_reforecast(date, varname, steps=None, ext=[-179.5, -110., 10., 70.]):
+    ## window and ensemble mean are computed per lead-time chunk as the data is loaded
+    ## steps (h) limits the files that are read, e.g., to the lead times in the mclimate
+    forecast = open_reforecast(date, varname, steps=steps, ext=ext)
     forecast = forecast.mean('number') # ensemble mean
     forecast = forecast.load()
 
     return forecast
 
-def load_mclimate(mon, day, varname, server):
+def get_mclimate_path(server):
+    ## location of mclimate data
+    if server == 'skyriver':
+        path_to_data = '/data/projects/operations/GEFS_Mclimate/data/' # skyriver
+    elif server == 'expanse':
+        path_to_data = '/expanse/nfs/cw3e/cwp140/preprocessed/' # expanse 
+    return path_to_data
+
+def get_mclimate_store_fname(varname, path_to_data, dvar=None):
+    ## filenames of the day-of-year mclimate store (index file if dvar is None)
+    fname = path_to_data + '{0}_mclimate/GEFSv12_reforecast_mclimate_{0}'.format(varname)
+    if dvar is None:
+        return fname + '_index.npz'
+    return fname + '_{0}.npy'.format(dvar)
+
+def normalize_mclimate_coords(ds, varname):
+    if (varname == 'ivt') | (varname == 'uv1000'):
+        ds = ds.rename({'longitude': 'lon', 'latitude': 'lat'}) # need to rename this to match GEFSv12 Reforecast
+    return ds
+
+def build_mclimate_store(varname, server=None, path_to_data=None, ext=[-179.5, -110., 10., 70.]):
+    '''
+    Converts the per-day GEFSv12_reforecast_mclimate_{varname}_{MMDD}.nc files into a 
+    single day-of-year store per variable that load_mclimate can memory-map
+    
+    The store is one .npy file per data variable with dimensions (day, ...) and 
+    coordinates already normalized, plus an _index.npz sidecar with the day list,
+    dimension names and coordinate values.
+    
+    Parameters
+    ----------
+    varname : str
+        'ivt', 'freezing_level' or 'uv1000'
+    server : str
+        'skyriver' or 'expanse'
+    path_to_data : str
+        directory containing the {varname}_mclimate folder (overrides server)
+    ext : list
+        [minlon, maxlon, minlat, maxlat] domain to keep in the store (None keeps the full grid)
+  
+    Returns
+    -------
+    index_fname : str
+        filename of the store index
+    
+    '''
+    if path_to_data is None:
+        path_to_data = get_mclimate_path(server)
+    ## every day of a non-leap year (leap day uses 02-28)
+    days = pd.date_range('2001-01-01', '2001-12-31', freq='1D').strftime('%m%d')
+    fname_pattern = path_to_data + '{0}_mclimate/GEFSv12_reforecast_mclimate_{0}_{1}.nc'
+    
+    ## the store is built in temporary files that replace the existing store at the end,
+    ## so load_mclimate never reads a partly built store (same as build_mclimate)
+    index_fname = get_mclimate_store_fname(varname, path_to_data)
+    tmp_index_fname = index_fname[:-len('.npz')] + '.{0}.tmp.npz'.format(os.getpid())
+    tmp_fnames = {} # store filename: temporary filename
+    store = {}
+    available = np.zeros(len(days), dtype=bool)
+    try:
+        for i, mmdd in enumerate(days):
+            fname = fname_pattern.format(varname, mmdd)
+            if os.path.exists(fname) == False:
+                print('...missing {0}'.format(fname))
+                continue
+            with xr.open_dataset(fname) as ds:
+                ds = normalize_mclimate_coords(ds, varname)
+                if ext is not None:
+                    ds = subset_to_domain(ds, ext)
+                if len(store) == 0:
+                    ## use the first day for the dimensions and coordinates of the store
+                    dims = ds[list(ds.data_vars)[0]].dims
+                    coords = {dim: ds[dim].values for dim in dims}
+                    for dvar in ds.data_vars:
+                        shape = (len(days),) + ds[dvar].shape
+                        store_fname = get_mclimate_store_fname(varname, path_to_data, dvar)
+                        tmp_fnames[store_fname] = store_fname[:-len('.npy')] + '.{0}.tmp.npy'.format(os.getpid())
+                        store[dvar] = np.lib.format.open_memmap(tmp_fnames[store_fname], mode='w+',
+                                                                dtype=ds[dvar].dtype, shape=shape)
+                for dvar in store:
+                    store[dvar][i] = ds[dvar].transpose(*dims).values
+            available[i] = True
+
+        for dvar in store:
+            store[dvar].flush()
+        np.savez(tmp_index_fname, days=np.asarray(days, dtype='U4'), available=available, dims=np.asarray(dims),
+                 data_vars=np.asarray(list(store)), **{'coord_' + dim: coords[dim] for dim in dims})
+        for store_fname, tmp_fname in tmp_fnames.items():
+            os.replace(tmp_fname, store_fname)
+        os.replace(tmp_index_fname, index_fname)
+    except BaseException:
+        ## a failed build leaves the existing store as it was
+        for fname in list(tmp_fnames.values()) + [tmp_index_fname]:
+            if os.path.exists(fname):
+                os.remove(fname)
+        raise
+
+    return index_fname
+
+def reforecast_dates(varname):
+    ## initialization dates of the preprocessed reforecast files, {Timestamp: date string used in the filenames}
+    ## (the directory is listed again, and the listing is reused by reforecast_fnames)
+    dates = {}
+    for date in list_reforecast(varname, refresh=True):
+        dates[pd.to_datetime(date, format='%Y%m%d%H' if len(date) == 10 else '%Y%m%d')] = date
+    return dates
+
+def mclimate_windows(dates, days, years=range(2000, 2020), half_width=45):
+    '''
+    Reforecast dates within half_width days of each calendar day (MMDD) of each year
+    
+    Returns
+    -------
+    windows : list
+        set of date strings (keys of dates) for each day in days
+    '''
+    ts = pd.DatetimeIndex(sorted(dates))
+    windows = []
+    for mmdd in days:
+        window = set()
+        for year in years:
+            center = pd.Timestamp('{0}{1}'.format(year, mmdd))
+            i0 = ts.searchsorted(center - pd.Timedelta(days=half_width), side='left')
+            i1 = ts.searchsorted(center + pd.Timedelta(days=half_width), side='right')
+            window.update([dates[t] for t in ts[i0:i1]])
+        windows.append(window)
+    return windows
+
+def build_mclimate(varname, server=None, path_to_data=None, years=range(2000, 2020), half_width=45, members=5,
+                   ext=[-179.5, -110., 10., 70.], max_memory=8e9, days=None):
+    '''
+    Builds the day-of-year mclimate store (see build_mclimate_store) from the preprocessed reforecast
+    
+    The mclimate of each calendar day is the quant_lst quantiles of every reforecast member 
+    initialized within half_width days of that day over the selected years, for each step 
+    and grid cell. Quantiles are exact (np.quantile). The grid is split into tiles of steps and 
+    latitude rows so the samples of one tile fit in max_memory. Each tile keeps a buffer of the 
+    samples in the window; moving to the next day only reads the dates that enter the window 
+    and drops the dates that leave it, so every reforecast file is read once per tile.
+    
+    Parameters
+    ----------
+    varname : str
+        'ivt', 'freezing_level' or 'uv1000'
+    server : str
+        'skyriver' or 'expanse'
+    path_to_data : str
+        directory containing the {varname}_mclimate folder (overrides server)
+    years : list
+        years of the reforecast in the mclimate
+    half_width : int
+        days before and after each calendar day in the window
+    members : int
+        number of ensemble members used from each reforecast (dates with fewer are skipped)
+    ext : list
+        [minlon, maxlon, minlat, maxlat] domain of the mclimate
+    max_memory : float
+        bytes for the samples of one tile
+    days : list
+        calendar days (MMDD) to rebuild in an existing store (None builds every day)
+  
+    Returns
+    -------
+    index_fname : str
+        filename of the store index
+    
+    '''
+    if path_to_data is None:
+        path_to_data = get_mclimate_path(server)
+    os.makedirs(path_to_data + '{0}_mclimate'.format(varname), exist_ok=True)
+    dvar = 'uv' if varname == 'uv1000' else varname
+    all_days = pd.date_range('2001-01-01', '2001-12-31', freq='1D').strftime('%m%d').tolist()
+    if days is None:
+        days = all_days
+    dates = reforecast_dates(varname)
+    windows = mclimate_windows(dates, days, years=years, half_width=half_width)
+    
+    ## grid and lead times from the first reforecast
+    template = open_reforecast(dates[min(dates)], varname, ext=ext)[dvar]
+    lats = template.lat.values
+    lons = template.lon.values
+    steps = template.step.values
+    dims = ['quantile', 'step', 'lat', 'lon']
+    coords = {'quantile': np.asarray(quant_lst), 'step': steps, 'lat': lats, 'lon': lons}
+    
+    ## store of every calendar day, updated in place only when the existing store has the same grid;
+    ## otherwise it is built in temporary files that replace the store at the end, so load_mclimate 
+    ## never reads a partly built store with the index of the old one
+    index_fname = get_mclimate_store_fname(varname, path_to_data)
+    shape = (len(all_days), len(quant_lst), len(steps), len(lats), len(lons))
+    store_fname = get_mclimate_store_fname(varname, path_to_data, dvar)
+    tmp_store_fname = store_fname[:-len('.npy')] + '.{0}.tmp.npy'.format(os.getpid())
+    tmp_index_fname = index_fname[:-len('.npz')] + '.{0}.tmp.npz'.format(os.getpid())
+    available = np.zeros(len(all_days), dtype=bool)
+    in_place = False
+    if os.path.exists(store_fname) and os.path.exists(index_fname):
+        existing = np.load(store_fname, mmap_mode='r')
+        with np.load(index_fname) as index:
+            in_place = (existing.shape == shape) & (existing.dtype == np.float32) & (index['data_vars'].tolist() == [dvar]) & \
+                       all([np.array_equal(index['coord_' + dim], coords[dim]) for dim in dims])
+            if in_place:
+                available = index['available'].copy()
+        del existing
+    if in_place:
+        store = np.load(store_fname, mmap_mode='r+')
+    else:
+        store = np.lib.format.open_memmap(tmp_store_fname, mode='w+', dtype=np.float32, shape=shape)
+    
+    try:
+        ## tiles of steps and latitude rows that fit in max_memory
+        capacity = max([len(w) for w in windows])*members
+        row_bytes = capacity*len(lons)*4
+        nrows = int(min(len(lats), max(1, max_memory // row_bytes)))
+        nsteps = int(min(len(steps), max(1, max_memory // (row_bytes*nrows))))
+        print('...{0} samples per grid cell, tiles of {1} steps x {2} rows'.format(capacity, nsteps, nrows))
+    
+        for j0 in range(0, len(steps), nsteps):
+            for i0 in range(0, len(lats), nrows):
+                buf = None
+                slots = [] # date held by each slot of the buffer, the first len(slots) slots are in use
+                skipped = set()
+                for d, mmdd in enumerate(days):
+                    ## drop the dates that left the window (the last slot is moved into the free one)
+                    for date in [date for date in slots if date not in windows[d]]:
+                        k = slots.index(date)
+                        buf[k*members:(k+1)*members] = buf[(len(slots)-1)*members:len(slots)*members]
+                        slots[k] = slots[-1]
+                        slots.pop()
+                    ## read the dates that entered the window
+                    for date in sorted(windows[d] - set(slots) - skipped):
+                        ## only the lead-time files of this tile are opened
+                        da = open_reforecast(date, varname, steps=steps[j0:j0+nsteps], ext=ext)[dvar].isel(lat=slice(i0, i0+nrows))
+                        if da.sizes['number'] < members:
+                            print('...skipping {0}, {1} members'.format(date, da.sizes['number']))
+                            skipped.add(date)
+                            continue
+                        vals = da.isel(number=slice(0, members)).transpose('number', 'step', 'lat', 'lon').values
+                        if buf is None:
+                            buf = np.empty((capacity,) + vals.shape[1:], dtype=np.float32)
+                        k = len(slots)
+                        buf[k*members:(k+1)*members] = vals
+                        slots.append(date)
+                    if len(slots) == 0:
+                        continue
+                
+                    ## exact quantiles, one step at a time so only one step of samples is copied
+                    iday = all_days.index(mmdd)
+                    for j in range(buf.shape[1]):
+                        store[iday, :, j0+j, i0:i0+buf.shape[2]] = np.quantile(buf[:len(slots)*members, j], quant_lst, axis=0)
+                    available[iday] = True
+                print('...Finished steps {0}-{1}, rows {2}-{3}'.format(steps[j0], steps[min(j0+nsteps, len(steps))-1], i0, i0+nrows))
+    
+        store.flush()
+        del store
+        np.savez(tmp_index_fname, days=np.asarray(all_days, dtype='U4'), available=available, dims=np.asarray(dims),
+                 data_vars=np.asarray([dvar]), **{'coord_' + dim: coords[dim] for dim in dims})
+        if in_place == False:
+            os.replace(tmp_store_fname, store_fname)
+        os.replace(tmp_index_fname, index_fname)
+    except BaseException:
+        ## a failed build leaves the existing store as it was
+        for fname in [tmp_store_fname, tmp_index_fname]:
+            if os.path.exists(fname):
+                os.remove(fname)
+        raise
+    
+    return index_fname
+
+def domain_indexer(lats, lons, ext):
+    ## index slices for [minlon, maxlon, minlat, maxlat] (works for ascending or descending coordinates)
+    lat_idx = pd.Index(lats)
+    if lat_idx.is_monotonic_increasing:
+        ilat = lat_idx.slice_indexer(ext[2], ext[3])
+    else:
+        ilat = lat_idx.slice_indexer(ext[3], ext[2])
+    ilon = pd.Index(lons).slice_indexer(ext[0], ext[1])
+    return {'lat': ilat, 'lon': ilon}
+
+def subset_to_domain(ds, ext):
+    return ds.isel(domain_indexer(ds.lat.values, ds.lon.values, ext))
+
+@instrument.timed()
+def load_mclimate_store(mmdd, varname, path_to_data, ext=[-179.5, -110., 10., 70.]):
+    '''
+    Reads a single day and lat/lon window from the day-of-year mclimate store
+    without reading or copying the rest of the grid
+    '''
+    with np.load(get_mclimate_store_fname(varname, path_to_data)) as index:
+        days = index['days'].tolist()
+        dims = index['dims'].tolist()
+        data_vars = index['data_vars'].tolist()
+        coords = {dim: index['coord_' + dim] for dim in dims}
+        iday = days.index(mmdd)
+        if index['available'][iday] == False:
+            raise FileNotFoundError('{0} mclimate for {1} is not in the store'.format(varname, mmdd))
+
+    window = domain_indexer(coords['lat'], coords['lon'], ext)
+    sl = (iday,) + tuple(window.get(dim, slice(None)) for dim in dims)
+    coords = {dim: coords[dim][window.get(dim, slice(None))] for dim in dims}
+
+    var_dict = {}
+    for dvar in data_vars:
+        arr = np.load(get_mclimate_store_fname(varname, path_to_data, dvar), mmap_mode='r')
+        var_dict[dvar] = (dims, np.array(arr[sl])) # copies only the requested day and window
+    ds = xr.Dataset(var_dict, coords=coords)
+
+    return ds
+
+## mclimate days already read in this process (kept warm in daemon mode), keyed by (MMDD, varname, path)
+mclimate_cache = {}
+mclimate_cache_size = 6
+
+@instrument.timed()
+def load_mclimate(mon, day, varname, server, path_to_data=None):
     if varname == 'UV1000':
         varname == 'uv1000'
     ## special circumstance for leap day
@@ -86,24 +667,32 @@ def load_mclimate(mon, day, varname, server):
         day = '28'
         
     ## load mclimate data
-    if server == 'skyriver':
-        path_to_data = '/data/projects/operations/GEFS_Mclimate/data/' # skyriver
-    elif server == 'expanse':
-        path_to_data = '/expanse/nfs/cw3e/cwp140/preprocessed/' # expanse 
+    if path_to_data is None:
+        path_to_data = get_mclimate_path(server)
+    key = (mon+day, varname, path_to_data)
+    if key not in mclimate_cache:
+        if len(mclimate_cache) >= mclimate_cache_size:
+            del mclimate_cache[next(iter(mclimate_cache))] # drop the oldest day
+        mclimate_cache[key] = read_mclimate(mon, day, varname, path_to_data)
+    return mclimate_cache[key]
+
+def read_mclimate(mon, day, varname, path_to_data):
+    ## read from the day-of-year store if it has been built (see build_mclimate_store)
+    if os.path.exists(get_mclimate_store_fname(varname, path_to_data)):
+        return load_mclimate_store(mon+day, varname, path_to_data)
+    
     fname = path_to_data + '{2}_mclimate/GEFSv12_reforecast_mclimate_{2}_{0}{1}.nc'.format(mon, day, varname)
     # print(fname_pattern)
     ds = xr.open_dataset(fname)
     # ds = ds.sortby("step") # sort by step (forecast lead)
-    if (varname == 'ivt') | (varname == 'uv1000'):
-        ds = ds.rename({'longitude': 'lon', 'latitude': 'lat'}) # need to rename this to match GEFSv12 Reforecast
-    else:
-        ds = ds
+    ds = normalize_mclimate_coords(ds, varname)
     ds = ds.sel(lon=slice(-179.5, -110.), lat=slice(70., 10.))
     ## load the data into memory
     ds = ds.load()
 
     return ds
 
+@instrument.timed()
 def load_archive_GEFS_forecast(date, varname):
     ### load forecast from GEFS
     if varname == 'ivt':
@@ -132,10 +721,14 @@ def load_archive_GEFS_forecast(date, varname):
 
     return forecast
 
-def run_compare_mclimate_forecast(varname, fdate, model, server):
-    ## load forecast data
+def parse_init_date(fdate):
+    ## YYYYMMDDHH or YYYYMMDD (reforecast and GEFS archive dates)
+    return pd.to_datetime(fdate, format='%Y%m%d%H' if len(fdate) == 10 else '%Y%m%d')
+
+def load_forecast(varname, fdate, model, steps=None):
+    ## load the forecast (step, lat, lon) of one variable, steps (h) only limits the reforecast files read
     if model == 'GEFSv12_reforecast':
-        forecast = load_reforecast(fdate, varname)
+        forecast = load_reforecast(fdate, varname, steps=steps)
 
     elif model == 'GFS':
         ## using operational GFS data
@@ -150,22 +743,326 @@ def run_compare_mclimate_forecast(varname, fdate, model, server):
     elif model == 'GEFS_archive':
         forecast = load_archive_GEFS_forecast(fdate, varname)
     
-    ## get month and date from the intialization date of the forecast
-    ts = pd.to_datetime(forecast.init_date.values, format="%Y%m%d%H")
-    mon = ts.strftime('%m')
-    day = ts.strftime('%d')
-    print(mon, day)
-    
-    ## load mclimate data based on the initialization date
-    mclimate = load_mclimate(mon, day, varname, server)
+    return forecast
+
+@instrument.timed()
+def run_compare_mclimate_forecast(varname, fdate, model, server, mode='discrete', codes=False):
+    if model == 'GEFSv12_reforecast':
+        ## the init date is known up front, so only the reforecast lead times in the mclimate are read
+        ts = parse_init_date(fdate)
+        mclimate = load_mclimate(ts.strftime('%m'), ts.strftime('%d'), varname, server)
+        forecast = load_forecast(varname, fdate, model, steps=mclimate.step.values)
+    else:
+        ## load forecast data
+        forecast = load_forecast(varname, fdate, model)
+        
+        ## get month and date from the intialization date of the forecast
+        ts = pd.to_datetime(forecast.init_date.values, format="%Y%m%d%H")
+        mon = ts.strftime('%m')
+        day = ts.strftime('%d')
+        print(mon, day)
+        
+        ## load mclimate data based on the initialization date
+        mclimate = load_mclimate(mon, day, varname, server)
 
     if (model == 'GEFS') | (model == 'GEFS_archive'):
         ## regrid/interpolate data to all have same grid size
+        ## bilinear weights are built once per grid pair and saved for later runs
         regrid_lats = forecast.lat
         regrid_lons = forecast.lon
-        mclimate = mclimate.interp(lon=regrid_lons, lat=regrid_lats)
+        mclimate = regrid.regrid_bilinear(mclimate, regrid_lats, regrid_lons,
+                                          cache_dir=get_mclimate_path(server) + 'regrid_weights/')
     
     ## compare the mclimate to the reforecast
-    ds = compare_mclimate_to_forecast(forecast, mclimate, varname)
+    ds = compare_mclimate_to_forecast(forecast, mclimate, varname, codes=codes, mode=mode)
+
+    return forecast, ds
+
+def dataset_varname(varname):
+    ## name of the variable in the forecast and merged datasets
+    return 'uv' if varname == 'uv1000' else varname
+
+def get_init_date(varname, model):
+    ## latest initialization date (YYYYMMDDHH) of the operational forecast
+    if model == 'GFS':
+        return ctools.load_GFS_datasets(varname).date_string
+    elif model == 'GEFS':
+        return ctools.load_GEFS_datasets(varname).date_string
+    raise ValueError('fdate is required for {0}'.format(model))
+
+def merge_mclimate_results(results, optional=[]):
+    ## {varname: (forecast, ds)} to one dataset with a variable per forecast variable (e.g., ivt, freezing_level, uv)
+    ds = xr.Dataset({dataset_varname(varname): ds.mclimate for varname, (forecast, ds) in results.items()})
+    ## only the steps of the required variables, an optional variable with more lead times does not add rows to the table
+    required = [varname for varname in results if varname not in optional]
+    if (len(required) > 0) & (len(required) < len(results)):
+        steps = np.unique(np.concatenate([results[varname][1].step.values for varname in required]))
+        ds = ds.sel(step=steps)
+    return ds
+
+def same_grid(a, b):
+    return np.array_equal(a.lat.values, b.lat.values) & np.array_equal(a.lon.values, b.lon.values)
+
+@instrument.timed()
+def run_compare_mclimate_forecasts(varname_lst, fdate, model, server, mode='discrete', nthreads=4, optional=[]):
+    '''
+    Compares several forecast variables to mclimate for one initialization date
+    
+    The forecasts and mclimates of the variables are read concurrently, and every 
+    variable is compared on the grid of the first variable's forecast. The mclimates
+    share one grid, so the regrid weights are built once.
+    
+    Parameters
+    ----------
+    varname_lst : list
+        variables, e.g., ['ivt', 'freezing_level', 'uv1000']
+    fdate : str
+        initialization date (YYYYMMDDHH), None uses the latest forecast of the first variable
+    model : str or dict
+        model for all variables, or {varname: model}, e.g., {'ivt': 'GEFS', 'uv1000': 'GFS'}
+    server : str
+        'skyriver' or 'expanse'
+    mode : str
+        'discrete' or 'continuous' (see compare_mclimate_to_forecast)
+    nthreads : int
+        number of variables read at once
+    optional : list
+        variables that are left out (with a message) if their forecast or mclimate can't be read, 
+        e.g., ['uv1000'] so a late GFS does not hold back the GEFS products
+  
+    Returns
+    -------
+    results : dict
+        {varname: (forecast, ds)} on the common grid for the variables that were read, with the
+        forecast and the comparison (output of compare_mclimate_to_forecast) at the steps of that variable
+    ds : xarray dataset
+        one variable per forecast variable (ivt, freezing_level, uv) with the mclimate percentile
+        at the steps of the required variables, as used by create_html_table
+    
+    '''
+    models = model if isinstance(model, dict) else {varname: model for varname in varname_lst}
+    if fdate is None:
+        fdate = get_init_date(varname_lst[0], models[varname_lst[0]])
+    ts = parse_init_date(fdate)
+    mon = ts.strftime('%m')
+    day = ts.strftime('%d')
+    
+    def load_variable(varname):
+        mclimate = load_mclimate(mon, day, varname, server)
+        ## only the reforecast lead times in the mclimate are read
+        steps = mclimate.step.values if models[varname] == 'GEFSv12_reforecast' else None
+        return load_forecast(varname, fdate, models[varname], steps=steps), mclimate
+    
+    ## read every variable at once
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        futures = {varname: pool.submit(load_variable, varname) for varname in varname_lst}
+        forecasts, mclimates = {}, {}
+        for varname in varname_lst:
+            try:
+                forecasts[varname], mclimates[varname] = futures[varname].result()
+            except Exception as e:
+                if varname not in optional:
+                    raise
+                print('...Leaving out {0}, it could not be read ({1!r})'.format(varname, e))
+    if len(forecasts) == 0:
+        raise FileNotFoundError('none of {0} could be read for {1}'.format(varname_lst, fdate))
+    
+    ## compare every variable on the grid of the first forecast
+    grid = forecasts[list(forecasts)[0]]
+    cache_dir = get_mclimate_path(server) + 'regrid_weights/'
+    results = {}
+    for varname in forecasts:
+        forecast = forecasts[varname]
+        if same_grid(forecast, grid) == False:
+            forecast = regrid.regrid_bilinear(forecast, grid.lat, grid.lon, cache_dir=cache_dir)
+        mclimate = mclimates[varname]
+        if same_grid(mclimate, grid) == False:
+            mclimate = regrid.regrid_bilinear(mclimate, grid.lat, grid.lon, cache_dir=cache_dir)
+        ds = compare_mclimate_to_forecast(forecast, mclimate, varname, mode=mode)
+        results[varname] = (forecast.sel(step=ds.step.values), ds)
+    
+    return results, merge_mclimate_results(results, optional=optional)
+
+def mclimate_codes(ds):
+    ## dataset with uint8 'mclimate' codes (8x smaller than the float quantile values)
+    if ds.mclimate.dtype == np.uint8:
+        return ds
+    if ds.mclimate.attrs.get('mode') == 'continuous':
+        raise ValueError("integer bin codes are only available for mode='discrete'")
+    return ds.assign(mclimate=(ds.mclimate.dims, encode_percentile_bins(ds.mclimate.values), code_attrs()))
+
+def mclimate_values(ds):
+    ## dataset with float 'mclimate' quantile values (NaN where undefined), as used for plots and tables
+    if ds.mclimate.dtype != np.uint8:
+        return ds
+    return ds.assign(mclimate=(ds.mclimate.dims, decode_percentile_bins(ds.mclimate.values), {'mode': 'discrete'}))
+
+def get_mclimate_product_fname(varname, init_date, path_to_data):
+    ## one file per variable and initialization date (YYYYMMDDHH)
+    return os.path.join(path_to_data, '{0}_mclimate_{1}.nc'.format(varname, init_date))
+
+def write_mclimate_product(ds, varname, path_to_data):
+    '''
+    Writes the output of compare_mclimate_to_forecast to a compressed netCDF file
+    chunked by forecast step
+    
+    Discrete results are stored as uint8 codes with the lookup table in the attributes;
+    continuous results are packed to uint16 (0.0001 resolution).
+    
+    Parameters
+    ----------
+    ds : xarray dataset
+        dataset with 'mclimate' variable (step, lat, lon) and init_date coordinate
+    varname : str
+        'ivt', 'freezing_level' or 'uv1000'
+    path_to_data : str
+        directory for the product files
+  
+    Returns
+    -------
+    fname : str
+        product filename
+    
+    '''
+    init_date = pd.to_datetime(ds.init_date.values).strftime('%Y%m%d%H')
+    fname = get_mclimate_product_fname(varname, init_date, path_to_data)
+    ds = ds.transpose('step', 'lat', 'lon')
+    encoding = {'zlib': True, 'complevel': 4, 'shuffle': True,
+                'chunksizes': (1, len(ds.lat), len(ds.lon))}
+    if ds.mclimate.attrs.get('mode') == 'continuous':
+        encoding.update({'dtype': 'uint16', 'scale_factor': 1e-4, '_FillValue': np.uint16(65535)})
+    else:
+        ds = mclimate_codes(ds)
+        encoding.update({'_FillValue': None}) # missing_code is kept as is, so the codes are read back as uint8
+    
+    os.makedirs(path_to_data, exist_ok=True)
+    tmp_fname = fname + '.{0}.tmp'.format(os.getpid())
+    ds.to_netcdf(tmp_fname, encoding={'mclimate': encoding})
+    os.replace(tmp_fname, fname) # readers never see a partial file
+    return fname
+
+def read_mclimate_product(varname, init_date, path_to_data, decode=True):
+    '''
+    Reads a product written by write_mclimate_product
+    
+    If decode is True, discrete codes are converted to quantile values so the result 
+    matches compare_mclimate_to_forecast; otherwise the uint8 codes are returned.
+    '''
+    fname = get_mclimate_product_fname(varname, init_date, path_to_data)
+    with xr.open_dataset(fname) as ds:
+        ds = ds.load()
+    if decode:
+        ds = mclimate_values(ds)
+    return ds
+
+def iter_compare_mclimate_forecast(varname_lst, fdate, model, server, mode='discrete', poll_interval=60., timeout=10800., optional=[]):
+    '''
+    Compares each forecast lead time to mclimate as soon as its data is available
+    
+    Lead times are processed in order. Only one lead time of forecast data is read at a time.
+    
+    Parameters
+    ----------
+    varname_lst : list
+        variables to compare, e.g., ['ivt', 'freezing_level']
+    fdate : str
+        initialization date (YYYYMMDDHH), None uses the latest forecast of the first variable
+    model : str or dict
+        'GFS' or 'GEFS' for all variables, or {varname: model}
+    server : str
+        'skyriver' or 'expanse'
+    mode : str
+        'discrete' or 'continuous' (see compare_mclimate_to_forecast)
+    poll_interval : float
+        seconds to wait between checks for new data
+    timeout : float
+        seconds to wait for a lead time before skipping it
+    optional : list
+        variables that are left out if they can't be read, and that are not waited on 
+        (a lead time includes them only if their data is ready)
+  
+    Yields
+    ------
+    step : int
+        forecast lead time (hours)
+    results : dict
+        {varname: (forecast, ds)} for this lead time, as returned by run_compare_mclimate_forecast,
+        with every variable on the grid of the first variable (see run_compare_mclimate_forecasts)
+    
+    '''
+    models = model if isinstance(model, dict) else {varname: model for varname in varname_lst}
+    ## required variables first, so the first one sets the initialization date and the grid
+    varname_lst = [varname for varname in varname_lst if varname not in optional] + [varname for varname in varname_lst if varname in optional]
+    loaders, mclimates = {}, {}
+    for varname in varname_lst:
+        try:
+            if models[varname] == 'GFS':
+                s = ctools.load_GFS_datasets(varname, fdate, complete=False) # lead times are waited on below
+            elif models[varname] == 'GEFS':
+                s = ctools.load_GEFS_datasets(varname, fdate)
+            else:
+                raise ValueError('streaming is only available for GFS and GEFS, got {0}'.format(models[varname]))
+            ## load mclimate data based on the initialization date
+            ts = pd.to_datetime(s.model_init_date)
+            mclimates[varname] = load_mclimate(ts.strftime('%m'), ts.strftime('%d'), varname, server)
+        except Exception as e:
+            if varname not in optional:
+                raise
+            print('...Leaving out {0}, it could not be read ({1!r})'.format(varname, e))
+            continue
+        fdate = s.date_string # all variables use the same initialization date
+        loaders[varname] = s
+    required = [varname for varname in loaders if varname not in optional]
+    regridded = {varname: False for varname in loaders}
+    cache_dir = get_mclimate_path(server) + 'regrid_weights/'
+    
+    ## forecast hours available for every required variable and in the mclimate
+    step_lst = [step for step in loaders[required[0]].step_lst
+                if all([(step in loaders[varname].step_lst) & (step in mclimates[varname].step.values) for varname in required])]
+    
+    for step in step_lst:
+        start = time.time()
+        while all([loaders[varname].step_ready(step) for varname in required]) == False:
+            if (time.time() - start) > timeout:
+                break
+            time.sleep(poll_interval)
+        if all([loaders[varname].step_ready(step) for varname in required]) == False:
+            print('...Skipping F{0}, data was not available after {1} s'.format(step, timeout))
+            continue
+        
+        results = {}
+        for varname, s in loaders.items():
+            if (varname in optional) and ((step not in s.step_lst) or (step not in mclimates[varname].step.values) or (s.step_ready(step) == False)):
+                print('...Leaving out {0} F{1}, it is not available yet'.format(varname, step))
+                continue
+            forecast = s.read_step(step)
+            if varname == required[0]:
+                grid = forecast
+            elif same_grid(forecast, grid) == False:
+                forecast = regrid.regrid_bilinear(forecast, grid.lat, grid.lon, cache_dir=cache_dir)
+            if (regridded[varname] == False) and (same_grid(mclimates[varname], grid) == False):
+                ## regrid the mclimate once, using the grid of the first lead time
+                mclimates[varname] = regrid.regrid_bilinear(mclimates[varname], grid.lat, grid.lon, cache_dir=cache_dir)
+            regridded[varname] = True
+            ds = compare_mclimate_to_forecast(forecast, mclimates[varname].sel(step=[step]), varname, mode=mode)
+            results[varname] = (forecast, ds)
+        
+        yield step, results
+
+@instrument.timed()
+def run_compare_mclimate_ensemble(varname, fdate, server, exceed_quant=[0.9, 0.95, 0.99], member_chunk=5, mode='discrete'):
+    ## using operational GEFS data, keeping all members
+    s = ctools.load_GEFS_datasets(varname, fdate)
+    forecast = s.calc_vars(member_chunk=member_chunk, ensemble_mean=False)
+    
+    ## load mclimate data based on the initialization date
+    ts = pd.to_datetime(forecast.init_date.values, format="%Y%m%d%H")
+    mclimate = load_mclimate(ts.strftime('%m'), ts.strftime('%d'), varname, server)
+    mclimate = regrid.regrid_bilinear(mclimate, forecast.lat, forecast.lon,
+                                      cache_dir=get_mclimate_path(server) + 'regrid_weights/')
+    
+    ## compare each member to the mclimate
+    ds = compare_mclimate_to_ensemble(forecast, mclimate, varname, exceed_quant=exceed_quant,
+                                      member_chunk=member_chunk, mode=mode)
 
-    return forecast, ds
\ No newline at end of file
+    return ds
\ No newline at end of file
@@ -9,6 +9,11 @@ Description: Functions for plotting
 import os, sys
 import numpy as np
 import itertools
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import xarray as xr
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
@@ -27,8 +32,10 @@ mpl.use('agg')
 
 ## import personal modules
 import custom_cmaps as ccmap
+import instrument
+from publish_funcs import staging_fname, publish_file
     
-def draw_basemap(ax, datacrs=ccrs.PlateCarree(), extent=None, xticks=None, yticks=None, grid=False, left_lats=True, right_lats=False, bottom_lons=True, mask_ocean=False, coastline=True):
+def draw_basemap(ax, datacrs=ccrs.PlateCarree(), extent=None, xticks=None, yticks=None, grid=False, left_lats=True, right_lats=False, bottom_lons=True, mask_ocean=False, coastline=True, features=True):
     """
     Creates and returns a background map on which to plot data. 
     
@@ -62,6 +69,10 @@ def draw_basemap(ax, datacrs=ccrs.PlateCarree(), extent=None, xticks=None, ytick
     right_lats : bool
         Whether to add latitude labels on the right side. Default: False
         
+    features : bool
+        Whether to draw the land, border and coastline features. Default: True
+        (False when a pre-rendered background is used)
+        
     Returns
     -------
     ax :
@@ -83,9 +94,10 @@ def draw_basemap(ax, datacrs=ccrs.PlateCarree(), extent=None, xticks=None, ytick
     mapcrs = ax.projection    
     
     # Add map features (continents and country borders)
-    ax.add_feature(cfeature.LAND, facecolor='0.9')      
-    ax.add_feature(cfeature.BORDERS, edgecolor='0.4', linewidth=0.8)
-    if coastline == True:
+    if features == True:
+        ax.add_feature(cfeature.LAND, facecolor='0.9')      
+        ax.add_feature(cfeature.BORDERS, edgecolor='0.4', linewidth=0.8)
+    if (coastline == True) & (features == True):
         ax.add_feature(cfeature.COASTLINE, edgecolor='0.4', linewidth=0.8)
     if mask_ocean == True:
         ax.add_feature(cfeature.OCEAN, edgecolor='0.4', zorder=12, facecolor='white') # mask ocean
@@ -140,28 +152,18 @@ def draw_basemap(ax, datacrs=ccrs.PlateCarree(), extent=None, xticks=None, ytick
     
     return ax
 
-def plot_mclimate_forecast(ds, fc, step, varname, fname, ext=[-170., -120., 50., 75.]):
+def subset_to_extent(ds, ext):
+    ## subset to [minlon, maxlon, minlat, maxlat] for ascending or descending latitudes
     ls = ds.isel(lat=0).lat.values
     le = ds.isel(lat=-1).lat.values
-
     if ls < le:
         ds = ds.sel(lon=slice(ext[0], ext[1]), lat=slice(ext[2], ext[3]))
-        fc = fc.sel(lon=slice(ext[0], ext[1]), lat=slice(ext[2], ext[3]))
     else:
         ds = ds.sel(lon=slice(ext[0], ext[1]), lat=slice(ext[3], ext[2]))
-        fc = fc.sel(lon=slice(ext[0], ext[1]), lat=slice(ext[3], ext[2]))
+    return ds
 
-    if varname == 'uv1000':
-        varname = 'uv'
-    ts = pd.to_datetime(ds.init_date.values, format="%Y%m%d%H") 
-    init_date = ts.strftime('%Y%m%d%H')
-    # Set up projection
-    mapcrs = ccrs.PlateCarree()
-    datacrs = ccrs.PlateCarree()
-    
-    # Set tick/grid locations
-    lats = ds.lat.values
-    lons = ds.lon.values
+def get_map_ticks(ext, lats, lons):
+    ## tick/grid locations
     if ext == [-170., -120., 40., 65.]:
         dx = [-160, -150, -140, -130]
         dy = [45., 50., 55., 60.]
@@ -171,92 +173,330 @@ def plot_mclimate_forecast(ds, fc, step, varname, fname, ext=[-170., -120., 50.,
     else:
         dx = np.arange(lons.min().round(),lons.max().round()+10,10)
         dy = np.arange(lats.min().round(),lats.max().round()+10,10)
+    return dx, dy
+
+class mclimate_map_template:
+    '''
+    Figure for plot_mclimate_forecast with the static layers (basemap, gridlines,
+    colorbar and annotation) drawn once for an extent and variable. Each call to 
+    render only swaps the mclimate shading, the forecast contours and the text.
     
-    # Create figure
-    fig = plt.figure(figsize=(9.5, 6.25))
-    fig.dpi = 600
-    fmt = 'png'
-    
-    nrows = 3
-    ncols = 1
-    
-    # contour labels
-    kw_clabels = {'fontsize': 7, 'inline': True, 'inline_spacing': 7, 'fmt': '%i',
-                  'rightside_up': True, 'use_clabeltext': True}
-    
-    kw_ticklabels = {'size': 10, 'color': 'dimgray', 'weight': 'light'}
-    
-    ## Use gridspec to set up a plot with a series of subplots that is
-    ## n-rows by n-columns
-    gs = GridSpec(nrows, ncols, height_ratios=[1, 0.05, 0.05], width_ratios = [1], wspace=0.05, hspace=0.1)
-    ## use gs[rows index, columns index] to access grids
-    
-    ax = fig.add_subplot(gs[0, 0], projection=mapcrs)
+    Parameters
+    ----------
+    varname : str
+        'ivt', 'freezing_level' or 'uv'
+    ext : list
+        map extent [minlon, maxlon, minlat, maxlat]
+    lats, lons : 1-D arrays
+        grid of the data within the extent
+    background_dir : str
+        directory of pre-rendered map backgrounds shared between processes;
+        if a background for this map exists it is used instead of drawing the
+        cartopy features, otherwise one is saved (None always draws the features)
+    
+    '''
+    def __init__(self, varname, ext, lats, lons, background_dir=None):
+        self.varname = varname
+        self.ext = ext
+        self.lats = lats
+        self.lons = lons
         
-    ax = draw_basemap(ax, extent=ext, xticks=dx, yticks=dy, left_lats=True, right_lats=False, bottom_lons=True)
-    
-    ## set cmap and contour values based on varname
-    if varname == 'ivt':
-        cmap_name = 'mclimate_red'
-        clevs = np.arange(250., 2100., 250.)
-    elif varname == 'freezing_level':
-        cmap_name = 'mclimate_green'
-        clevs = np.arange(0., 60000., 2000.)
-        fc[varname] = fc[varname]*3.281 # convert to feet
-    elif varname == 'uv':
-        cmap_name = 'mclimate_purple'
-        clevs = np.arange(0., 55., 5.)
-    
-    # Contour Filled (mclimate values)
-    data = ds.sel(step=step).mclimate.values*100.
-    cmap, norm, bnds, cbarticks, cbarlbl = ccmap.cmap(cmap_name)
-    cf = ax.pcolormesh(lons, lats, data, transform=datacrs,
-                       cmap=cmap, norm=norm, alpha=0.9)
-    # cf = ax.contourf(lons, lats, data, transform=datacrs,
-    #                  levels=bnds, cmap=cmap, norm=norm, alpha=0.9, extend='neither')
+        # Set up projection
+        mapcrs = ccrs.PlateCarree()
+        self.datacrs = ccrs.PlateCarree()
+        
+        # Set tick/grid locations
+        dx, dy = get_map_ticks(ext, lats, lons)
+        
+        # Create figure
+        fig = plt.figure(figsize=(9.5, 6.25))
+        fig.dpi = 600
+        self.fmt = 'png'
+        
+        nrows = 3
+        ncols = 1
+        
+        # contour labels
+        self.kw_clabels = {'fontsize': 7, 'inline': True, 'inline_spacing': 7, 'fmt': '%i',
+                           'rightside_up': True, 'use_clabeltext': True}
+        
+        kw_ticklabels = {'size': 10, 'color': 'dimgray', 'weight': 'light'}
+        
+        ## Use gridspec to set up a plot with a series of subplots that is
+        ## n-rows by n-columns
+        gs = GridSpec(nrows, ncols, height_ratios=[1, 0.05, 0.05], width_ratios = [1], wspace=0.05, hspace=0.1)
+        ## use gs[rows index, columns index] to access grids
+        
+        ax = fig.add_subplot(gs[0, 0], projection=mapcrs)
+        
+        ## pre-rendered background of the map features, if another process has saved one
+        background_fname = None
+        if background_dir is not None:
+            key = '{0}_{1}_{2}'.format('_'.join(['{0:g}'.format(e) for e in ext]), fig.dpi, 'x'.join(map(str, fig.get_size_inches())))
+            background_fname = os.path.join(background_dir, 'basemap_{0}.png'.format(key))
+        use_background = (background_fname is not None) and os.path.exists(background_fname)
+            
+        ax = draw_basemap(ax, extent=ext, xticks=dx, yticks=dy, left_lats=True, right_lats=False, bottom_lons=True, features=(use_background == False))
+        if use_background:
+            ax.imshow(plt.imread(background_fname), origin='upper', extent=ax.get_extent(crs=mapcrs),
+                      transform=mapcrs, interpolation='none', zorder=0)
+            ax.set_extent(ext, crs=self.datacrs)
+        
+        ## set cmap and contour values based on varname
+        if varname == 'ivt':
+            cmap_name = 'mclimate_red'
+            self.clevs = np.arange(250., 2100., 250.)
+            self.fc_scale = 1.
+        elif varname == 'freezing_level':
+            cmap_name = 'mclimate_green'
+            self.clevs = np.arange(0., 60000., 2000.)
+            self.fc_scale = 3.281 # convert to feet
+        elif varname == 'uv':
+            cmap_name = 'mclimate_purple'
+            self.clevs = np.arange(0., 55., 5.)
+            self.fc_scale = 1.
+        
+        # Contour Filled (mclimate values), data is swapped in for each step
+        cmap, norm, bnds, cbarticks, cbarlbl = ccmap.cmap(cmap_name)
+        self.bnds = bnds
+        cf = ax.pcolormesh(lons, lats, np.full((len(lats), len(lons)), np.nan), transform=self.datacrs,
+                           cmap=cmap, norm=norm, alpha=0.9)
+        # cf = ax.contourf(lons, lats, data, transform=datacrs,
+        #                  levels=bnds, cmap=cmap, norm=norm, alpha=0.9, extend='neither')
+        
+        # Add color bar
+        cbax = plt.subplot(gs[1,0]) # colorbar axis
+        cbarticks = list(itertools.compress(bnds, cbarticks)) ## this labels the cbarticks based on the cmap dictionary
+        cb = Colorbar(ax = cbax, mappable = cf, orientation = 'horizontal', 
+                      ticklocation = 'bottom', ticks=cbarticks)
+        cb.set_label(cbarlbl, fontsize=11)
+        cb.ax.tick_params(labelsize=12)
+        
+        ann_ax = fig.add_subplot(gs[-1, 0])
+        ann_ax.axis('off')
+        self.ann = ann_ax.annotate('', # text is set for each step
+                   (0, 0.3), # these are the coordinates to position the label
+                    textcoords="offset points", # how to position the text
+                    xytext=(0,-19), # distance from text to points (x,y)
+                    ha='left', # horizontal alignment can be left, right or center
+                    **kw_ticklabels)
+        
+        self.fig = fig
+        self.ax = ax
+        self.cf = cf
+        self.cs = None
+        
+        if (background_fname is not None) and (use_background == False):
+            self.save_background(background_fname)
 
-    # Contour Lines (forecast values)
-    forecast = fc.sel(step=step)     
-    cs = ax.contour(lons, lats, forecast[varname], transform=datacrs,
-                     levels=clevs, colors='k',
-                     linewidths=0.75, linestyles='solid')
-    plt.clabel(cs, **kw_clabels)
+    def save_background(self, fname):
+        ## save the map features within the axes so other processes can skip drawing them
+        self.fig.canvas.draw()
+        buf = np.asarray(self.fig.canvas.buffer_rgba())
+        x0, y0, x1, y1 = np.round(self.ax.bbox.extents).astype(int)
+        nrows = buf.shape[0]
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp_fname = fname + '.{0}.tmp.png'.format(os.getpid())
+        plt.imsave(tmp_fname, buf[nrows-y1:nrows-y0, x0:x1])
+        os.replace(tmp_fname, fname)
 
-    
-    # Add color bar
-    cbax = plt.subplot(gs[1,0]) # colorbar axis
-    cbarticks = list(itertools.compress(bnds, cbarticks)) ## this labels the cbarticks based on the cmap dictionary
-    cb = Colorbar(ax = cbax, mappable = cf, orientation = 'horizontal', 
-                  ticklocation = 'bottom', ticks=cbarticks)
-    cb.set_label(cbarlbl, fontsize=11)
-    cb.ax.tick_params(labelsize=12)
-    
-    init_time = ts.strftime('%HZ %d %b %Y')
-    start_date = ts - timedelta(days=45)
-    start_date = start_date.strftime('%d-%b')
-    end_date = ts + timedelta(days=45)
-    end_date = end_date.strftime('%d-%b')
-    
-    ts_valid = ts + timedelta(hours=int(step))
-    valid_time = ts_valid.strftime('%HZ %d %b %Y')
-    
-    ax.set_title('Initialized: {0}'.format(init_time), loc='left', fontsize=10)
-    ax.set_title('F-{0} | Valid: {1}'.format(int(step), valid_time), loc='right', fontsize=10)
+    def render(self, ds, fc, step, fname):
+        ds = subset_to_extent(ds, self.ext)
+        fc = subset_to_extent(fc, self.ext)
+        varname = self.varname
+        
+        ts = pd.to_datetime(ds.init_date.values, format="%Y%m%d%H") 
+        
+        # Contour Filled (mclimate values)
+        data = ds.sel(step=step).mclimate.values*100.
+        if ds.mclimate.attrs.get('mode') == 'continuous':
+            data = np.where(data < self.bnds[0], np.nan, data) # only shade above the lowest bound, as with discrete bins
+        self.cf.set_array(np.ma.masked_invalid(data))
+        
+        # Contour Lines (forecast values)
+        if self.cs is not None:
+            self.cs.remove()
+        forecast = fc.sel(step=step)[varname].values*self.fc_scale
+        ## label placement depends on the axes position, so place labels against the
+        ## position before the aspect adjustment made when drawing, as in a new figure
+        self.ax.set_position(self.ax.get_position(original=True), which='active')
+        self.ax.set_in_layout(True)
+        self.cs = self.ax.contour(self.lons, self.lats, forecast, transform=self.datacrs,
+                                  levels=self.clevs, colors='k',
+                                  linewidths=0.75, linestyles='solid')
+        self.ax.clabel(self.cs, **self.kw_clabels)
+        
+        init_time = ts.strftime('%HZ %d %b %Y')
+        start_date = ts - timedelta(days=45)
+        start_date = start_date.strftime('%d-%b')
+        end_date = ts + timedelta(days=45)
+        end_date = end_date.strftime('%d-%b')
+        
+        ts_valid = ts + timedelta(hours=int(step))
+        valid_time = ts_valid.strftime('%HZ %d %b %Y')
+        
+        self.ax.set_title('Initialized: {0}'.format(init_time), loc='left', fontsize=10)
+        self.ax.set_title('F-{0} | Valid: {1}'.format(int(step), valid_time), loc='right', fontsize=10)
+        
+        txt = 'Relative to all {2}-h GEFSv12 reforecasts initialized between {0} and {1} (2000-2019)'.format(start_date, end_date, step)
+        self.ann.set_text(textwrap.fill(txt, 101))
+        
+        ## save to the staging directory and move into place, so the website never shows a partial image
+        out_fname = '%s.%s' %(fname, self.fmt)
+        tmp_fname = staging_fname(out_fname)
+        self.fig.savefig(tmp_fname, bbox_inches='tight', dpi=self.fig.dpi, format=self.fmt)
+        publish_file(tmp_fname, out_fname)
+
+    def close(self):
+        plt.close(self.fig)
+
+## map templates built in this process, keyed by variable, extent and grid
+map_templates = {}
+
+def get_map_template(varname, ext, lats, lons, background_dir=None):
+    key = (varname, tuple(ext), lats.tobytes(), lons.tobytes(), background_dir)
+    if key not in map_templates:
+        map_templates[key] = mclimate_map_template(varname, ext, lats, lons, background_dir)
+    return map_templates[key]
+
+@instrument.timed()
+def plot_mclimate_forecast(ds, fc, step, varname, fname, ext=[-170., -120., 50., 75.], background_dir=None):
+    if varname == 'uv1000':
+        varname = 'uv'
+    ## the figure and static map layers are reused for every step with the same extent and grid
+    grid = subset_to_extent(ds, ext)
+    template = get_map_template(varname, ext, grid.lat.values, grid.lon.values, background_dir)
+    template.render(ds, fc, step, fname)
 
+def share_array(arr):
+    ## copy an array into a new shared memory block
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[:] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+def read_shared_slice(desc, i):
+    ## copy index i along the first axis out of a shared memory block
+    ## workers share the parent's resource tracker, so the parent unlinks the block
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.array(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)[i])
+    shm.close()
+    return arr
+
+def render_job(job):
+    '''
+    Rebuilds the single-step mclimate and forecast datasets for one plot from
+    shared memory and renders it. Returns None or the traceback of the failure,
+    and the instrument records made in the worker.
+    '''
+    nrec = len(instrument.records)
+    try:
+        i = job['istep']
+        step = job['steps'][i]
+        ds = xr.Dataset({'mclimate': (['step', 'lat', 'lon'], read_shared_slice(job['mclimate'], [i]), job['attrs'])},
+                        coords={'lat': job['lat'], 'lon': job['lon'], 'step': [step], 'init_date': job['init_date']})
+        fc = xr.Dataset({job['fc_varname']: (['step', 'lat', 'lon'], read_shared_slice(job['fc'], [job['fc_istep']]))},
+                        coords={'lat': job['fc_lat'], 'lon': job['fc_lon'], 'step': [step]})
+        plot_mclimate_forecast(ds, fc, step=step, varname=job['varname'], fname=job['fname'], ext=job['ext'],
+                               background_dir=job['background_dir'])
+    except Exception:
+        return traceback.format_exc(), instrument.records[nrec:]
+    return None, instrument.records[nrec:]
+
+## worker pools kept between calls of render_mclimate_forecasts(persistent=True), keyed by number of processes
+render_pools = {}
+
+def get_render_pool(nprocs):
+    ## the workers keep their map templates, fonts and map features between calls
+    if nprocs not in render_pools:
+        render_pools[nprocs] = ProcessPoolExecutor(max_workers=nprocs, mp_context=multiprocessing.get_context('fork'))
+    return render_pools[nprocs]
+
+@instrument.timed()
+def render_mclimate_forecasts(jobs, nprocs=1, background_dir=None, persistent=False):
+    '''
+    Renders plot_mclimate_forecast for a list of (variable, step) jobs on a process pool
     
-    txt = 'Relative to all {2}-h GEFSv12 reforecasts initialized between {0} and {1} (2000-2019)'.format(start_date, end_date, step)
-    ann_ax = fig.add_subplot(gs[-1, 0])
-    ann_ax.axis('off')
-    ann_ax.annotate(textwrap.fill(txt, 101), # this is the text
-               (0, 0.3), # these are the coordinates to position the label
-                textcoords="offset points", # how to position the text
-                xytext=(0,-19), # distance from text to points (x,y)
-                ha='left', # horizontal alignment can be left, right or center
-                **kw_ticklabels)
+    The mclimate and forecast arrays of each variable are copied once into shared 
+    memory; workers only copy out the step they are plotting.
     
-    fig.savefig('%s.%s' %(fname, fmt), bbox_inches='tight', dpi=fig.dpi)
+    Parameters
+    ----------
+    jobs : list of tuples
+        (ds, fc, varname, step, fname, ext) with the same arguments as plot_mclimate_forecast
+    nprocs : int
+        number of worker processes (1 renders in this process)
+    background_dir : str
+        directory of pre-rendered map backgrounds (see mclimate_map_template)
+    persistent : bool
+        keep the worker processes for the next call (see get_render_pool)
+  
+    Returns
+    -------
+    failures : list of tuples
+        (varname, step, fname, traceback) for each job that failed, in job order
+    
+    '''
+    if nprocs <= 1:
+        failures = []
+        for ds, fc, varname, step, fname, ext in jobs:
+            try:
+                plot_mclimate_forecast(ds, fc, step=step, varname=varname, fname=fname, ext=ext, background_dir=background_dir)
+            except Exception:
+                failures.append((varname, step, fname, traceback.format_exc()))
+        return failures
+    
+    shm_lst = []
+    shared = {}
+    job_lst = []
+    failures = {} # job index: failure, for jobs that fail here or in a worker
+    try:
+        for n, (ds, fc, varname, step, fname, ext) in enumerate(jobs):
+            ## a job that can't be prepared fails on its own, as it would when rendered serially
+            try:
+                fc_varname = 'uv' if varname == 'uv1000' else varname
+                key = (id(ds), id(fc), fc_varname)
+                if key not in shared:
+                    ## publish each variable once, no matter how many steps are plotted
+                    shm, mclim_desc = share_array(ds.mclimate.transpose('step', 'lat', 'lon').values)
+                    shm_lst.append(shm)
+                    shm, fc_desc = share_array(fc[fc_varname].transpose('step', 'lat', 'lon').values)
+                    shm_lst.append(shm)
+                    shared[key] = {'mclimate': mclim_desc, 'fc': fc_desc, 'attrs': ds.mclimate.attrs,
+                                   'lat': ds.lat.values, 'lon': ds.lon.values, 'steps': ds.step.values.tolist(),
+                                   'init_date': ds.init_date.values, 'fc_varname': fc_varname,
+                                   'fc_lat': fc.lat.values, 'fc_lon': fc.lon.values, 'fc_steps': fc.step.values.tolist()}
+                job = dict(shared[key])
+                job.update({'istep': job['steps'].index(step), 'fc_istep': job['fc_steps'].index(step),
+                            'varname': varname, 'fname': fname, 'ext': ext, 'background_dir': background_dir, 'n': n})
+                job_lst.append(job)
+            except Exception:
+                failures[n] = (varname, step, fname, traceback.format_exc())
+        
+        ## results are collected in job order regardless of completion order
+        if len(job_lst) == 0:
+            results = []
+        elif persistent:
+            try:
+                results = list(get_render_pool(nprocs).map(render_job, job_lst))
+            except BrokenProcessPool:
+                render_pools.pop(nprocs).shutdown(wait=False) # start new workers on the next call
+                raise
+        else:
+            with ProcessPoolExecutor(max_workers=nprocs, mp_context=multiprocessing.get_context('fork')) as pool:
+                results = list(pool.map(render_job, job_lst))
+    finally:
+        for shm in shm_lst:
+            shm.close()
+            shm.unlink()
 
-    plt.close(fig)
+    for job, (result, recs) in zip(job_lst, results):
+        instrument.records.extend(recs)
+        if result is not None:
+            failures[job['n']] = (job['varname'], job['steps'][job['istep']], job['fname'], result)
+    return [failures[n] for n in sorted(failures)]
 
 def plot_mclimate_forecast_comparison(ds_lst, fc_lst, varname, fname, ext=[-170., -120., 40., 65.]):
     if varname == 'uv1000':
@@ -0,0 +1,174 @@
+"""
+Filename:    product_cache.py
+Author:      Deanna Nash, dnash@ucsd.edu
+Description: Content-addressed cache of rendered products so reruns skip plots and pages whose inputs have not changed
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+## plots are redrawn whenever the plotting code changes
+plot_code_fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plotter.py')
+
+def update_hash(h, *items):
+    '''
+    Adds arrays, strings and numbers to a hashlib object
+    '''
+    for item in items:
+        if isinstance(item, np.ndarray):
+            arr = np.ascontiguousarray(item)
+            h.update(str((arr.dtype.str, arr.shape)).encode())
+            h.update(arr.tobytes())
+        else:
+            h.update(repr(item).encode())
+    return h
+
+def file_hash(fname):
+    '''
+    Returns the sha1 of the contents of a file
+    '''
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def plot_job_hash(ds, fc, varname, step, ext, plot_code_hash=None):
+    '''
+    Returns the hash of everything a plot_mclimate_forecast image depends on
+
+    Parameters
+    ----------
+    ds : xarray dataset
+        mclimate comparison (output of compare_mclimate_to_forecast)
+    fc : xarray dataset
+        forecast dataset
+    varname : str
+        plotted variable
+    step : int
+        forecast lead time
+    ext : list
+        map extent [minlon, maxlon, minlat, maxlat]
+    plot_code_hash : str
+        hash of the plotting code (None reads plotter.py)
+
+    Returns
+    -------
+    key : str
+        hex digest
+    '''
+    if plot_code_hash is None:
+        plot_code_hash = file_hash(plot_code_fname)
+    fc_varname = 'uv' if varname == 'uv1000' else varname
+    mclim = ds.mclimate.sel(step=step)
+    forecast = fc[fc_varname].sel(step=step)
+
+    h = hashlib.sha1()
+    update_hash(h, plot_code_hash, varname, int(step), [float(x) for x in ext],
+                sorted(mclim.attrs.items()), str(ds.init_date.values),
+                mclim.values, mclim.lat.values, mclim.lon.values,
+                forecast.values, forecast.lat.values, forecast.lon.values)
+    return h.hexdigest()
+
+def page_hash(df_html, header_fname, footer_fname):
+    '''
+    Returns the hash of the table and the header and footer the page is built from
+    '''
+    h = hashlib.sha1()
+    update_hash(h, df_html, file_hash(header_fname), file_hash(footer_fname))
+    return h.hexdigest()
+
+class product_cache:
+    '''
+    Manifest of the products written by previous runs
+
+    Each entry maps an output file to the hash of its inputs and the
+    initialization date it was made for. A product is skipped when its
+    file still exists and the hash of its inputs is unchanged.
+
+    Parameters
+    ----------
+    manifest_fname : str
+        json file holding the manifest
+    max_age : float
+        entries initialized more than max_age hours before the newest entry are evicted on save
+
+    '''
+    def __init__(self, manifest_fname, max_age=72.):
+        self.manifest_fname = manifest_fname
+        self.max_age = max_age
+        self.manifest = {}
+        if os.path.exists(manifest_fname):
+            try:
+                with open(manifest_fname, 'r') as f:
+                    self.manifest = json.load(f)
+            except ValueError:
+                print('...Ignoring unreadable product manifest {0}'.format(manifest_fname))
+        self.plot_code_hash = file_hash(plot_code_fname)
+
+    def is_current(self, fname, key):
+        entry = self.manifest.get(fname)
+        return (entry is not None) and (entry['hash'] == key) and os.path.exists(fname)
+
+    def update(self, fname, key, init_date):
+        self.manifest[fname] = {'hash': key, 'init_date': pd.to_datetime(init_date).strftime('%Y%m%d%H')}
+
+    def evict(self):
+        '''
+        Removes entries for old initialization dates and for files that no longer exist
+        '''
+        if len(self.manifest) == 0:
+            return []
+        newest = max([pd.to_datetime(entry['init_date'], format='%Y%m%d%H') for entry in self.manifest.values()])
+        cutoff = newest - pd.Timedelta(hours=self.max_age)
+        stale = [fname for fname, entry in self.manifest.items()
+                 if (pd.to_datetime(entry['init_date'], format='%Y%m%d%H') < cutoff) or (not os.path.exists(fname))]
+        for fname in stale:
+            del self.manifest[fname]
+        return stale
+
+    def save(self):
+        self.evict()
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_fname)), exist_ok=True)
+        tmp_fname = self.manifest_fname + '.{0}.tmp'.format(os.getpid())
+        with open(tmp_fname, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_fname, self.manifest_fname)
+
+    def filter_plot_jobs(self, jobs, fmt='png'):
+        '''
+        Splits render_mclimate_forecasts jobs into those that need rendering and those already current
+
+        Returns
+        -------
+        todo : list
+            jobs to render
+        keys : list
+            (image fname, hash, init_date) of each job in todo, for update after rendering
+        nskip : int
+            number of jobs skipped
+        '''
+        todo, keys = [], []
+        nskip = 0
+        for job in jobs:
+            ds, fc, varname, step, fname, ext = job
+            key = plot_job_hash(ds, fc, varname, step, ext, plot_code_hash=self.plot_code_hash)
+            out_fname = '{0}.{1}'.format(fname, fmt)
+            if self.is_current(out_fname, key):
+                nskip += 1
+                continue
+            todo.append(job)
+            keys.append((out_fname, key, ds.init_date.values))
+        return todo, keys, nskip
+
+    def update_plot_jobs(self, keys, failures):
+        '''
+        Records the rendered jobs that did not fail
+        '''
+        failed = set(['{0}.'.format(fname) for varname, step, fname, err in failures])
+        for out_fname, key, init_date in keys:
+            if out_fname[:out_fname.rindex('.')+1] not in failed:
+                self.update(out_fname, key, init_date)
@@ -0,0 +1,38 @@
+"""
+Filename:    publish_funcs.py
+Author:      Deanna Nash, dnash@ucsd.edu
+Description: Functions for publishing files to the website atomically through a staging directory
+"""
+
+import os
+
+def staging_fname(fname):
+    '''
+    Returns a unique file name in the .staging directory next to fname
+    
+    The staging directory is on the same filesystem as fname, so moving the
+    staged file into place is a single atomic rename.
+    '''
+    staging_dir = os.path.join(os.path.dirname(os.path.abspath(fname)), '.staging')
+    os.makedirs(staging_dir, exist_ok=True)
+    base, ext = os.path.splitext(os.path.basename(fname))
+    return os.path.join(staging_dir, '{0}.{1}{2}'.format(base, os.getpid(), ext))
+
+def publish_file(staged_fname, fname):
+    ## readers see either the old file or the complete new one
+    os.replace(staged_fname, fname)
+
+def publish_text(text, fname):
+    '''
+    Writes text to fname in a single write to the staging directory, then renames it into place
+    '''
+    tmp_fname = staging_fname(fname)
+    try:
+        with open(tmp_fname, 'w') as f:
+            f.write(text)
+        publish_file(tmp_fname, fname)
+    except BaseException:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+    return fname
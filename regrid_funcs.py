@@ -0,0 +1,166 @@
+"""
+Filename:    regrid_funcs.py
+Author:      Deanna Nash, dnash@ucsd.edu
+Description: Functions for regridding the GEFSv12 mClimate to the forecast grid with cached bilinear weights
+"""
+
+import os
+import hashlib
+import numpy as np
+import xarray as xr
+import scipy.sparse as sp
+
+import instrument
+
+## regrid weights already built in this process, keyed by grid hash
+weights_cache = {}
+
+def grid_hash(src_lat, src_lon, dst_lat, dst_lon):
+    '''
+    Returns a short hash identifying a source and target grid pair
+    '''
+    h = hashlib.sha1()
+    for coord in [src_lat, src_lon, dst_lat, dst_lon]:
+        coord = np.ascontiguousarray(coord, dtype=np.float64)
+        h.update(str(coord.shape).encode())
+        h.update(coord.tobytes())
+    return h.hexdigest()[:16]
+
+def linear_weights_1d(src, dst):
+    '''
+    Linear interpolation indices and weights along a single axis
+
+    Parameters
+    ----------
+    src : 1-D array
+        source coordinate (ascending or descending)
+    dst : 1-D array
+        target coordinate
+
+    Returns
+    -------
+    i0, i1 : int arrays
+        indices of the neighboring source points for each target point
+    w0, w1 : float arrays
+        weights of the neighboring source points
+    valid : bool array
+        False where the target point is outside the source coordinate
+    '''
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.asarray(dst, dtype=np.float64)
+    order = np.argsort(src)
+    s = src[order]
+    j = np.searchsorted(s, dst, side='right') - 1
+    j = np.clip(j, 0, len(s)-2)
+    valid = (dst >= s[0]) & (dst <= s[-1])
+    w1 = (dst - s[j]) / (s[j+1] - s[j])
+
+    return order[j], order[j+1], 1. - w1, w1, valid
+
+def build_bilinear_weights(src_lat, src_lon, dst_lat, dst_lon):
+    '''
+    Builds a sparse (ndst, nsrc) matrix of bilinear interpolation weights
+    between two regular lat/lon grids (flattened in lat, lon order)
+
+    Returns
+    -------
+    W : scipy.sparse.csr_matrix
+        bilinear weights
+    valid : bool array (ndst,)
+        False for target points outside the source grid
+    '''
+    lat0, lat1, wlat0, wlat1, vlat = linear_weights_1d(src_lat, dst_lat)
+    lon0, lon1, wlon0, wlon1, vlon = linear_weights_1d(src_lon, dst_lon)
+    nx_src = len(src_lon)
+    nsrc = len(src_lat)*nx_src
+    ndst = len(dst_lat)*len(dst_lon)
+
+    ## each target point gets weights from its four neighbors
+    rows = np.arange(ndst).reshape(len(dst_lat), len(dst_lon))
+    row_lst, col_lst, w_lst = [], [], []
+    for ilat, wlat in [(lat0, wlat0), (lat1, wlat1)]:
+        for ilon, wlon in [(lon0, wlon0), (lon1, wlon1)]:
+            row_lst.append(rows.ravel())
+            col_lst.append((ilat[:, np.newaxis]*nx_src + ilon[np.newaxis, :]).ravel())
+            w_lst.append((wlat[:, np.newaxis]*wlon[np.newaxis, :]).ravel())
+    W = sp.coo_matrix((np.concatenate(w_lst), (np.concatenate(row_lst), np.concatenate(col_lst))),
+                      shape=(ndst, nsrc)).tocsr()
+    ## drop zero weights so exact grid hits do not pick up NaN neighbors
+    W.eliminate_zeros()
+    valid = (vlat[:, np.newaxis] & vlon[np.newaxis, :]).ravel()
+
+    return W, valid
+
+def get_regrid_weights(src_lat, src_lon, dst_lat, dst_lon, cache_dir=None):
+    '''
+    Returns bilinear weights for the grid pair, building them only if they are
+    not already in memory or saved in cache_dir
+    '''
+    key = grid_hash(src_lat, src_lon, dst_lat, dst_lon)
+    if key in weights_cache:
+        return weights_cache[key]
+
+    fname = None
+    if cache_dir is not None:
+        fname = os.path.join(cache_dir, 'bilinear_weights_{0}.npz'.format(key))
+
+    if (fname is not None) and os.path.exists(fname):
+        with np.load(fname) as f:
+            W = sp.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            valid = f['valid']
+    else:
+        W, valid = build_bilinear_weights(src_lat, src_lon, dst_lat, dst_lon)
+        if fname is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_fname = fname + '.{0}.tmp.npz'.format(os.getpid())
+            np.savez(tmp_fname, data=W.data, indices=W.indices, indptr=W.indptr,
+                     shape=np.asarray(W.shape), valid=valid)
+            os.replace(tmp_fname, fname) # other processes never see a partial file
+
+    weights_cache[key] = (W, valid)
+    return W, valid
+
+@instrument.timed()
+def regrid_bilinear(ds, lat, lon, cache_dir=None):
+    '''
+    Bilinear regridding of every lat/lon variable in ds to the target grid.
+    Equivalent to ds.interp(lat=lat, lon=lon), but the weights are reused across
+    calls and all other dimensions (e.g., quantile, step) are regridded in one
+    sparse matrix product.
+
+    Parameters
+    ----------
+    ds : xarray dataset
+        dataset with lat and lon dimensions
+    lat, lon : xarray DataArray or 1-D array
+        target grid coordinates
+    cache_dir : str
+        directory to save/load the weights (None keeps them in memory only)
+
+    Returns
+    -------
+    ds : xarray dataset
+        dataset regridded to the target grid
+    '''
+    lat = np.asarray(lat)
+    lon = np.asarray(lon)
+    W, valid = get_regrid_weights(ds.lat.values, ds.lon.values, lat, lon, cache_dir)
+
+    var_dict = {}
+    for varname, da in ds.data_vars.items():
+        if ('lat' not in da.dims) | ('lon' not in da.dims):
+            var_dict[varname] = da
+            continue
+        other_dims = [dim for dim in da.dims if dim not in ('lat', 'lon')]
+        da = da.transpose(*other_dims, 'lat', 'lon')
+        arr = da.values.reshape(-1, len(ds.lat)*len(ds.lon))
+        out = np.asarray(W @ arr.T).T
+        out[:, ~valid] = np.nan
+        out = out.reshape(da.shape[:-2] + (len(lat), len(lon)))
+        var_dict[varname] = (other_dims + ['lat', 'lon'], out, da.attrs)
+
+    coords = {name: coord for name, coord in ds.coords.items() if ('lat' not in coord.dims) & ('lon' not in coord.dims)}
+    coords['lat'] = ('lat', lat)
+    coords['lon'] = ('lon', lon)
+
+    return xr.Dataset(var_dict, coords=coords, attrs=ds.attrs)
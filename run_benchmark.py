@@ -0,0 +1,246 @@
+"""
+Filename:    run_benchmark.py
+Author:      Deanna Nash, dnash@ucsd.edu
+Description: Times and measures peak memory of the load, compare, regrid, plot and table stages on synthetic GEFS-like data.
+             Runs offline; no /data, /expanse or /common paths are used.
+
+Example:
+    python run_benchmark.py --members 31 --repeat 3 --out benchmark.json
+    python run_benchmark.py --baseline benchmark.json --tolerance 0.25
+"""
+
+## import libraries
+import os, sys
+import io
+import json
+import time
+import argparse
+import tempfile
+import platform
+import resource
+import tracemalloc
+import contextlib
+import traceback
+import subprocess
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import matplotlib as mpl
+mpl.use('agg')
+
+# import personal modules
+import cw3e_tools as ctools
+import mclimate_funcs as mclim_func
+import regrid_funcs as regrid
+
+stage_lst = ['startup', 'load_forecast', 'load_mclimate', 'load_mclimate_store', 'regrid_cold', 'regrid_warm',
+             'compare', 'compare_continuous', 'plot', 'table']
+
+def make_forecast_file(fname, init_date, members=31, res=0.5, nsteps=29, seed=0):
+    '''
+    Writes a synthetic GEFS IVT_Full_{init}.nc file (ensemble, forecast_hour, lat, lon) with
+    0-359 longitudes and descending latitudes, covering the North Pacific
+    '''
+    rng = np.random.default_rng(seed)
+    lat = np.arange(90., 0.-res/2., -res)
+    lon = np.arange(150., 290.+res/2., res)
+    shape = (members, nsteps, len(lat), len(lon))
+    coords = {'ensemble': np.arange(members), 'forecast_hour': np.arange(nsteps)*6, 'lat': lat, 'lon': lon}
+    dims = ['ensemble', 'forecast_hour', 'lat', 'lon']
+    ds = xr.Dataset({'IVT': (dims, rng.gamma(2., 150., size=shape).astype(np.float32)),
+                     'uIVT': (dims, np.zeros(shape, dtype=np.float32)),
+                     'vIVT': (dims, np.zeros(shape, dtype=np.float32))}, coords=coords)
+    ds.to_netcdf(fname)
+    return fname
+
+def make_mclimate_file(fname, res=0.25, nsteps=28, seed=1):
+    '''
+    Writes a synthetic GEFSv12_reforecast_mclimate_ivt_{MMDD}.nc file (quantile, step, latitude, longitude)
+    '''
+    rng = np.random.default_rng(seed)
+    lat = np.arange(70., 10.-res/2., -res)
+    lon = np.arange(-179.5, -110.+res/2., res)
+    shape = (len(mclim_func.quant_lst), nsteps, len(lat), len(lon))
+    q = np.sort(rng.gamma(2., 150., size=shape).astype(np.float32), axis=0)
+    coords = {'quantile': mclim_func.quant_lst, 'step': (np.arange(nsteps)+1)*6, 'latitude': lat, 'longitude': lon}
+    ds = xr.Dataset({'ivt': (['quantile', 'step', 'latitude', 'longitude'], q)}, coords=coords)
+    ds.to_netcdf(fname)
+    return fname
+
+def measure(func, repeat=1):
+    '''
+    Runs func repeat times for timing, then once more under tracemalloc for peak memory
+
+    Returns
+    -------
+    result : dict
+        wall and CPU seconds of each run, their medians and the peak traced allocation (MB)
+    out :
+        return value of the last run
+    '''
+    wall, cpu = [], []
+    for i in range(repeat):
+        t0, c0 = time.perf_counter(), time.process_time()
+        out = func()
+        wall.append(time.perf_counter() - t0)
+        cpu.append(time.process_time() - c0)
+    tracemalloc.start()
+    try:
+        out = func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result = {'wall_s': wall, 'cpu_s': cpu, 'median_wall_s': float(np.median(wall)),
+              'median_cpu_s': float(np.median(cpu)), 'peak_mb': peak/1e6}
+    return result, out
+
+def run_benchmarks(args, workdir):
+    results = {}
+    init_date = '2024010100'
+
+    def run_stage(name, func):
+        if name not in args.stages:
+            return None
+        print('...{0}'.format(name))
+        try:
+            results[name], out = measure(func, repeat=args.repeat)
+            print('   {0:.3f} s, {1:.1f} MB'.format(results[name]['median_wall_s'], results[name]['peak_mb']))
+            return out
+        except Exception:
+            results[name] = {'error': traceback.format_exc()}
+            print('   failed')
+            print(results[name]['error'])
+            return None
+
+    ## import time of the compute-only path, in a new interpreter
+    def startup():
+        out = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_compute.py'), '--check-startup'],
+                             capture_output=True, text=True)
+        status = json.loads(out.stdout)
+        if status['ok'] == False:
+            raise RuntimeError('compute path startup over budget: {0}'.format(status))
+        return status
+    status = run_stage('startup', startup)
+    if status is not None:
+        results['startup'].update(status)
+
+    ## synthetic inputs
+    print('...Writing synthetic data to {0}'.format(workdir))
+    path_to_data = workdir + '/'
+    os.makedirs(path_to_data + 'ivt_mclimate', exist_ok=True)
+    fc_fname = make_forecast_file(os.path.join(workdir, 'IVT_Full_{0}.nc'.format(init_date)), init_date,
+                                  members=args.members, res=args.fc_res, nsteps=args.steps+1)
+    make_mclimate_file(path_to_data + 'ivt_mclimate/GEFSv12_reforecast_mclimate_ivt_0101.nc', res=args.mclimate_res, nsteps=args.steps)
+
+    ## GEFS ensemble mean for the domain
+    s = ctools.load_GEFS_datasets('ivt', fdate=init_date)
+    s.fname = fc_fname
+    s.step_lst = [int(step) for step in (np.arange(args.steps)+1)*6]
+    forecast = run_stage('load_forecast', lambda: s.calc_vars())
+    if forecast is None:
+        forecast = s.calc_vars()
+
+    ## mclimate from netCDF and from the day-of-year store
+    def load_mclimate():
+        mclim_func.mclimate_cache.clear() # time the read, not the in-memory cache
+        return mclim_func.load_mclimate('01', '01', 'ivt', None, path_to_data=path_to_data)
+    mclimate = run_stage('load_mclimate', load_mclimate)
+    if 'load_mclimate_store' in args.stages:
+        with contextlib.redirect_stdout(io.StringIO()): # one day is available, do not list the other 364
+            mclim_func.build_mclimate_store('ivt', path_to_data=path_to_data)
+        store = run_stage('load_mclimate_store', load_mclimate)
+        os.remove(mclim_func.get_mclimate_store_fname('ivt', path_to_data)) # later stages read the netCDF file
+        mclim_func.mclimate_cache.clear()
+        if mclimate is None:
+            mclimate = store
+    if mclimate is None:
+        mclimate = mclim_func.load_mclimate('01', '01', 'ivt', None, path_to_data=path_to_data)
+
+    ## GEFS interp of the mclimate to the forecast grid
+    def regrid_cold():
+        regrid.weights_cache.clear()
+        return regrid.regrid_bilinear(mclimate, forecast.lat, forecast.lon)
+    out = run_stage('regrid_cold', regrid_cold)
+    out = run_stage('regrid_warm', lambda: regrid.regrid_bilinear(mclimate, forecast.lat, forecast.lon))
+    mclimate = regrid.regrid_bilinear(mclimate, forecast.lat, forecast.lon)
+
+    ## comparison
+    ds = run_stage('compare', lambda: mclim_func.compare_mclimate_to_forecast(forecast, mclimate, 'ivt'))
+    out = run_stage('compare_continuous', lambda: mclim_func.compare_mclimate_to_forecast(forecast, mclimate, 'ivt', mode='continuous'))
+    if ds is None:
+        ds = mclim_func.compare_mclimate_to_forecast(forecast, mclimate, 'ivt')
+
+    ## one map (needs the Natural Earth shapefiles to be in the cartopy data directory)
+    if 'plot' in args.stages:
+        import plotter
+        fname = os.path.join(workdir, 'ivt_mclimate_F24')
+        out = run_stage('plot', lambda: plotter.plot_mclimate_forecast(ds, forecast, 24, 'ivt', fname, ext=[-170., -120., 40., 65.]))
+
+    ## html table
+    from build_html_table import create_html_table
+    tmp = xr.Dataset({'ivt': ds.mclimate, 'freezing_level': ds.mclimate, 'uv': ds.mclimate}).sortby('lat')
+    out = run_stage('table', lambda: create_html_table(tmp, 'SEAK').to_html())
+
+    return results
+
+def compare_to_baseline(results, baseline, tolerance):
+    ## stages whose median wall time grew by more than tolerance (fraction) relative to the baseline
+    regressions = []
+    for name, result in results.items():
+        base = baseline['stages'].get(name)
+        if (base is None) or ('median_wall_s' not in base) or ('median_wall_s' not in result):
+            continue
+        ratio = result['median_wall_s'] / max(base['median_wall_s'], 1e-9)
+        if ratio > 1. + tolerance:
+            regressions.append((name, base['median_wall_s'], result['median_wall_s'], ratio))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the M-Climate tool on synthetic data')
+    parser.add_argument('--members', type=int, default=31, help='number of ensemble members')
+    parser.add_argument('--steps', type=int, default=28, help='number of 6-hourly forecast steps')
+    parser.add_argument('--fc-res', type=float, default=0.5, help='forecast grid spacing (degrees)')
+    parser.add_argument('--mclimate-res', type=float, default=0.25, help='mclimate grid spacing (degrees)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage')
+    parser.add_argument('--stages', nargs='+', default=stage_lst, choices=stage_lst, help='stages to run')
+    parser.add_argument('--workdir', default=None, help='directory for the synthetic data (default: a temporary directory)')
+    parser.add_argument('--out', default=None, help='json file for the results')
+    parser.add_argument('--baseline', default=None, help='json results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed fractional slowdown relative to the baseline')
+    args = parser.parse_args()
+
+    if args.workdir is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        workdir = tmpdir.name
+    else:
+        workdir = args.workdir
+        os.makedirs(workdir, exist_ok=True)
+
+    stages = run_benchmarks(args, workdir)
+    output = {'config': {'members': args.members, 'steps': args.steps, 'fc_res': args.fc_res,
+                         'mclimate_res': args.mclimate_res, 'repeat': args.repeat},
+              'env': {'python': platform.python_version(), 'platform': platform.platform(),
+                      'numpy': np.__version__, 'pandas': pd.__version__, 'xarray': xr.__version__,
+                      'cpu_count': os.cpu_count()},
+              'date': pd.Timestamp.now().isoformat(),
+              'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3,
+              'stages': stages}
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(output, f, indent=1)
+        print('...Wrote results to {0}'.format(args.out))
+    else:
+        print(json.dumps(output, indent=1))
+
+    status = 0
+    if any(['error' in result for result in stages.values()]):
+        status = 1
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        for name, base, new, ratio in compare_to_baseline(stages, baseline, args.tolerance):
+            print('...Regression in {0}: {1:.3f} s -> {2:.3f} s ({3:.2f}x)'.format(name, base, new, ratio))
+            status = 1
+    sys.exit(status)
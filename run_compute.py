@@ -0,0 +1,71 @@
+"""
+Filename:    run_compute.py
+Author:      Deanna Nash, dnash@ucsd.edu
+Description: Compute-only entry point: compares a forecast to the M-Climate and writes the percentile grids to netCDF
+             (see write_mclimate_product).
+             No plotting or cartography packages are imported, so short-lived jobs (hindcasts, point queries) start quickly.
+
+Example:
+    python run_compute.py ivt freezing_level --model GEFS --out-dir /tmp/
+    python run_compute.py --check-startup
+"""
+
+import time
+t_start = time.perf_counter()
+
+## import libraries
+import os, sys
+import json
+import argparse
+import pandas as pd
+
+# import personal modules
+import mclimate_funcs as mclim_func
+
+import_time = time.perf_counter() - t_start
+
+## packages the compute path must not import, and the time allowed to import it (s)
+plotting_modules = ['matplotlib', 'cartopy', 'cmocean', 'PIL']
+startup_budget = 1.5
+
+def check_startup(budget=startup_budget):
+    '''
+    Returns the import time of the compute path, the plotting packages that were
+    imported anyway, and whether both are within budget
+    '''
+    loaded = [name for name in plotting_modules if name in sys.modules]
+    ok = (import_time <= budget) & (len(loaded) == 0)
+    return {'import_s': import_time, 'budget_s': budget, 'plotting_modules': loaded, 'ok': ok}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare a forecast to the M-Climate and write the percentile grids')
+    parser.add_argument('varname', nargs='*', default=['ivt'], help="variables, e.g., 'ivt' 'freezing_level' 'uv1000'")
+    parser.add_argument('--fdate', default=None, help='initialization date (YYYYMMDDHH), default is the latest forecast')
+    parser.add_argument('--model', default='GEFS', help="'GFS', 'GEFS', 'GEFS_archive' or 'GEFSv12_reforecast'")
+    parser.add_argument('--server', default='skyriver', help="'skyriver' or 'expanse'")
+    parser.add_argument('--mode', default='discrete', help="'discrete' or 'continuous'")
+    parser.add_argument('--out-dir', default='./', help='directory for the {varname}_mclimate_{init}.nc files')
+    parser.add_argument('--overwrite', action='store_true', help='recompute products that already exist')
+    parser.add_argument('--check-startup', action='store_true', help='only report the import time and plotting packages loaded')
+    args = parser.parse_args()
+
+    status = check_startup()
+    if args.check_startup:
+        print(json.dumps(status))
+        sys.exit(0 if status['ok'] else 1)
+    if status['ok'] == False:
+        print('...Startup over budget: {0:.2f} s (budget {1:.2f} s), plotting packages loaded: {2}'.format(status['import_s'], status['budget_s'], status['plotting_modules']))
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    fdate = args.fdate
+    for varname in args.varname:
+        if (fdate is not None) and (args.overwrite == False) and os.path.exists(mclim_func.get_mclimate_product_fname(varname, fdate, args.out_dir)):
+            print('...{0} M-Climate comparison for {1} already exists'.format(varname, fdate))
+            continue
+        print('...Comparing {0} to M-Climate'.format(varname))
+        ## discrete results are kept as uint8 codes
+        forecast, ds = mclim_func.run_compare_mclimate_forecast(varname, fdate, args.model, server=args.server, mode=args.mode,
+                                                                codes=(args.mode == 'discrete'))
+        fdate = pd.to_datetime(ds.init_date.values).strftime('%Y%m%d%H') # every variable uses the same initialization date
+        out_fname = mclim_func.write_mclimate_product(ds, varname, args.out_dir)
+        print('...Wrote {0}'.format(out_fname))
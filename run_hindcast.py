@@ -0,0 +1,163 @@
+"""
+Filename:    run_hindcast.py
+Author:      Deanna Nash, dnash@ucsd.edu
+Description: Hindcast (batch) mode: compares the GEFSv12 reforecast or archived GEFS forecasts for a range of initialization
+             dates to the M-Climate across a process pool, and writes the percentile grids of each date to netCDF
+             (see write_mclimate_product). Completed dates are recorded in a checkpoint file so an interrupted run resumes
+             where it stopped.
+
+Example:
+    python run_hindcast.py ivt freezing_level --start 20161101 --end 20170331 --model GEFSv12_reforecast --server expanse --nprocs 16 --out-dir /expanse/nfs/cw3e/cwp140/hindcast/
+"""
+
+## import libraries
+import os, sys
+import json
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+# import personal modules
+import mclimate_funcs as mclim_func
+from publish_funcs import publish_text
+
+def get_init_dates(start, end, freq='1D'):
+    ## initialization dates (YYYYMMDD) from start to end
+    return [ts.strftime('%Y%m%d') for ts in pd.date_range(start, end, freq=freq)]
+
+def group_by_day(date_lst):
+    '''
+    Groups initialization dates by month and day, so each worker reads the mclimate
+    of a day once and reuses it for every year with that day
+    '''
+    groups = {}
+    for fdate in date_lst:
+        groups.setdefault(fdate[4:8], []).append(fdate)
+    return [groups[mmdd] for mmdd in sorted(groups)]
+
+def read_checkpoint(fname):
+    ## {fdate: [varnames]} completed by earlier runs
+    if (fname is None) or (os.path.exists(fname) == False):
+        return {}
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        print('...Ignoring unreadable checkpoint {0}'.format(fname))
+        return {}
+
+def write_checkpoint(done, fname):
+    ## published atomically so an interrupted run never leaves a partial checkpoint
+    publish_text(json.dumps(done, indent=1, sort_keys=True), fname)
+
+def is_done(fdate, varname_lst, done, out_dir):
+    ## a date is done when the checkpoint lists every variable or every product already exists
+    if set(varname_lst) <= set(done.get(fdate, [])):
+        return True
+    return all([os.path.exists(mclim_func.get_mclimate_product_fname(varname, fdate + '00', out_dir)) for varname in varname_lst])
+
+def run_dates(date_lst, varname_lst, model, server, mode, out_dir):
+    '''
+    Compares each date and variable to the mclimate and writes the products (runs in a worker process)
+
+    Returns
+    -------
+    results : list
+        (fdate, varname, traceback or None) for each date and variable
+    '''
+    results = []
+    for fdate in date_lst:
+        for varname in varname_lst:
+            try:
+                ## discrete results are kept as uint8 codes
+                forecast, ds = mclim_func.run_compare_mclimate_forecast(varname, fdate, model, server=server, mode=mode,
+                                                                        codes=(mode == 'discrete'))
+                mclim_func.write_mclimate_product(ds, varname, out_dir)
+                results.append((fdate, varname, None))
+            except Exception:
+                results.append((fdate, varname, traceback.format_exc()))
+    return results
+
+def run_hindcast(date_lst, varname_lst, model, server, out_dir, mode='discrete', nprocs=1, checkpoint_fname=None):
+    '''
+    Runs the mclimate comparison for many initialization dates
+
+    Parameters
+    ----------
+    date_lst : list
+        initialization dates (YYYYMMDD)
+    varname_lst : list
+        variables, e.g., ['ivt', 'freezing_level']
+    model : str
+        'GEFSv12_reforecast' or 'GEFS_archive'
+    server : str
+        'skyriver' or 'expanse'
+    out_dir : str
+        directory for the {varname}_mclimate_{init}.nc files
+    mode : str
+        'discrete' or 'continuous' (see compare_mclimate_to_forecast)
+    nprocs : int
+        number of worker processes (1 runs serially)
+    checkpoint_fname : str
+        json file of the completed dates (default: hindcast_checkpoint.json in out_dir)
+
+    Returns
+    -------
+    failures : list
+        (fdate, varname, traceback) of each comparison that failed; these dates are retried on the next run
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    if checkpoint_fname is None:
+        checkpoint_fname = os.path.join(out_dir, 'hindcast_checkpoint.json')
+    done = read_checkpoint(checkpoint_fname)
+    todo = [fdate for fdate in date_lst if is_done(fdate, varname_lst, done, out_dir) == False]
+    print('...Skipping {0} completed dates, {1} to run'.format(len(date_lst) - len(todo), len(todo)))
+
+    failures = []
+    def record(results):
+        for fdate, varname, err in results:
+            if err is None:
+                done[fdate] = sorted(set(done.get(fdate, []) + [varname]))
+            else:
+                print('...Failed {0} {1}'.format(varname, fdate))
+                failures.append((fdate, varname, err))
+        write_checkpoint(done, checkpoint_fname)
+
+    groups = group_by_day(todo)
+    if nprocs <= 1:
+        for i, group in enumerate(groups):
+            record(run_dates(group, varname_lst, model, server, mode, out_dir))
+            print('...Finished {0} of {1} days'.format(i+1, len(groups)))
+        return failures
+
+    ## forked workers start with the modules already imported
+    with ProcessPoolExecutor(max_workers=nprocs, mp_context=multiprocessing.get_context('fork')) as pool:
+        futures = [pool.submit(run_dates, group, varname_lst, model, server, mode, out_dir) for group in groups]
+        for i, future in enumerate(as_completed(futures)):
+            record(future.result())
+            print('...Finished {0} of {1} days'.format(i+1, len(groups)))
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare many past forecasts to the M-Climate and write the percentile grids')
+    parser.add_argument('varname', nargs='*', default=['ivt'], help="variables, e.g., 'ivt' 'freezing_level' 'uv1000'")
+    parser.add_argument('--start', required=True, help='first initialization date (YYYYMMDD)')
+    parser.add_argument('--end', required=True, help='last initialization date (YYYYMMDD)')
+    parser.add_argument('--freq', default='1D', help='time between initialization dates (pandas frequency)')
+    parser.add_argument('--model', default='GEFSv12_reforecast', help="'GEFSv12_reforecast' or 'GEFS_archive'")
+    parser.add_argument('--server', default='expanse', help="'skyriver' or 'expanse'")
+    parser.add_argument('--mode', default='discrete', help="'discrete' or 'continuous'")
+    parser.add_argument('--nprocs', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--out-dir', default='./', help='directory for the {varname}_mclimate_{init}.nc files')
+    parser.add_argument('--checkpoint', default=None, help='json file of the completed dates (default: in out-dir)')
+    args = parser.parse_args()
+
+    date_lst = get_init_dates(args.start, args.end, freq=args.freq)
+    failures = run_hindcast(date_lst, args.varname, args.model, args.server, args.out_dir, mode=args.mode,
+                            nprocs=args.nprocs, checkpoint_fname=args.checkpoint)
+    for fdate, varname, err in failures:
+        print('...{0} {1}'.format(varname, fdate))
+        print(err)
+    sys.exit(1 if len(failures) > 0 else 0)
@@ -6,6 +6,8 @@ Description: For GFS, compare IVT to model climate every 6 hours for the next 10
 
 ## import libraries
 import os, sys
+import time
+import traceback
 import yaml
 import xarray as xr
 import pandas as pd
@@ -19,9 +21,11 @@ import matplotlib as mpl
 mpl.use('agg')
 
 # import personal modules
-from plotter import plot_mclimate_forecast
 import mclimate_funcs as mclim_func
-from build_html_table import create_html_table
+import cw3e_tools as ctools
+from build_html_table import create_html_table, write_html_page
+from product_cache import product_cache, page_hash
+import instrument
 
 
 ######################
@@ -29,77 +33,172 @@ from build_html_table import create_html_table
 ######################
 fdate = None ## initialization date in YYYYMMDD format
 model = 'GEFS' ## 'GEFSv12_reforecast', 'GFS', 'GEFS', 'GEFS_archive'
-map_ext = [-170., -120., 40., 65.] ## map extent [minlon, maxlon, minlat, maxlat]
-table_ext = [-141., -130., 54.5, 60.] ## extent to choose the maximum value from for the table [minlon, maxlon, minlat, maxlat]
-fig_path = '/data/projects/website/mirror/htdocs/Projects/MClimate/images/images_operational/'
-os.makedirs(os.path.dirname(fig_path), exist_ok=True)
-
-###########
-### IVT ###
-###########
-print('...Reading IVT data for M-Climate comparison')
-varname = 'ivt' ## 'freezing_level' or 'ivt'
-forecast, ds = mclim_func.run_compare_mclimate_forecast(varname, fdate, model, server='skyriver')
-step_lst = ds.step.values
-
-print('...Writing IVT plots')
-for i, step in enumerate(step_lst):
-    print(step)
-    out_fname = fig_path + '{0}_mclimate_F{1}'.format(varname, step)
-    plot_mclimate_forecast(ds, forecast, step=step, varname='ivt', fname=out_fname, ext=map_ext)
-
-######################
-### FREEZING LEVEL ###
-######################
-print('...Reading Freezing Level data for M-Climate comparison')
-varname = 'freezing_level'
-model = 'GEFS'
-ts = pd.to_datetime(forecast.init_date.values, format="%Y%m%d%H")
-fdate = ts.strftime('%Y%m%d%H')
-forecast, ds1 = mclim_func.run_compare_mclimate_forecast(varname, fdate, model, server='skyriver')
-
-print('...Writing Freezing Level plots')
-for i, step in enumerate(step_lst):
-    print(step)
-    out_fname = fig_path + '{0}_mclimate_F{1}'.format(varname, step)
-    plot_mclimate_forecast(ds1, forecast, step=step, varname='freezing_level', fname=out_fname, ext=[-141., -130., 54., 60.])
-
-## put into single dataset for table
-ds = ds.rename({'mclimate': 'IVT'})
-ds1 = ds1.rename({'mclimate': 'freezing_level'})
-ds2 = xr.merge([ds, ds1])
-ds2 = ds2.sortby('lat')
-
-###################
-### BUILD TABLE ###
-###################
-print('...Building Table')
-df = create_html_table(ds2, table_ext)
-## convert to html
-df_html = df.to_html(index=False, formatters={'Hour': lambda x: '<b>' + x + '</b>'}, escape=False)
-
-
-#######################
-### WRITE HTML FILE ###
-#######################
-print('...Writing HTML file')
-out_fname = "/data/projects/website/mirror/htdocs/Projects/MClimate/mclimate_tool_operational.html"
-
-with open('/data/projects/operations/GEFS_Mclimate/out/html_text.txt', mode='r') as in_file, \
-     open('/data/projects/operations/GEFS_Mclimate/out/html_text2.txt', mode='r') as in_file2, \
-     open(out_fname, mode='w') as out_file:
-
-    # A file is iterable
-    # We can read each line with a simple for loop
-    for line in in_file:
-        out_file.write(line)
-        
-        
-    ## now add in the table
-    out_file.write(df_html)
-
-    ## now add the last few lines
-    for line in in_file2:
-        out_file.write(line)
-        
-    out_file.close()
\ No newline at end of file
+varname_lst = ['ivt', 'freezing_level', 'uv1000'] ## variables compared to the M-Climate (the table has a column for each)
+models = {'ivt': model, 'freezing_level': 'GEFS', 'uv1000': 'GFS'} ## model each variable is read from
+optional_varnames = ['uv1000'] ## variables left out of the plots and table (instead of failing the run) when they can't be read
+mode = 'discrete' ## 'discrete' (mclimate quantile bins) or 'continuous' (interpolated percentile rank)
+config_fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regions.yaml') ## regions to make plots and tables for
+nprocs = 8 ## number of processes for rendering plots (1 renders serially)
+streaming = False ## True processes and publishes each lead time as soon as its data is available
+daemon = False ## True keeps running and processes each new forecast as soon as its files are complete
+poll_interval = 30. ## seconds between checks for a new forecast in daemon mode
+max_attempts = 3 ## times a forecast is tried in daemon mode before it is skipped
+use_cache = True ## skip plots and html pages whose inputs are unchanged since the last run
+manifest_fname = '/data/projects/operations/GEFS_Mclimate/out/product_manifest.json' ## record of the products written by previous runs
+product_dir = None ## directory to save the M-Climate comparison of each init and variable as netCDF (None does not save it)
+instrument_dir = None ## directory for a json record of stage timings and memory for each run (None turns this off)
+profile_stages = [] ## stages to run under cProfile when instrument_dir is set, e.g., ['compare_mclimate_to_forecast']
+
+with open(config_fname, 'r') as f:
+    regions = yaml.safe_load(f)['regions']
+for name, region in regions.items():
+    os.makedirs(os.path.dirname(region['fig_path']), exist_ok=True)
+if instrument_dir is not None:
+    instrument.enable(profile_stages, out_dir=instrument_dir)
+cache = product_cache(manifest_fname) if use_cache else None
+
+def region_plot_jobs(region, results):
+    ## (ds, fc, varname, step, fname, ext) for each plot of a region, at the steps compared for each variable
+    plot_jobs = []
+    for varname, ext in region['plots'].items():
+        if varname not in results:
+            continue # optional variable that could not be read
+        forecast, ds = results[varname]
+        for step in ds.step.values:
+            out_fname = region['fig_path'] + '{0}_mclimate_F{1}'.format(varname, step)
+            plot_jobs.append((ds, forecast, varname, step, out_fname, ext))
+    return plot_jobs
+
+def render_plots(plot_jobs, nprocs):
+    keys = []
+    if cache is not None:
+        plot_jobs, keys, nskip = cache.filter_plot_jobs(plot_jobs)
+        print('...Skipping {0} unchanged plots'.format(nskip))
+    if len(plot_jobs) == 0:
+        return
+    from plotter import render_mclimate_forecasts # cartopy and matplotlib are only imported once there is something to plot
+    failures = render_mclimate_forecasts(plot_jobs, nprocs=nprocs, persistent=daemon)
+    for varname, step, out_fname, err in failures:
+        print('...Failed to write {0} F{1} plot ({2})'.format(varname, step, out_fname))
+        print(err)
+    if cache is not None:
+        cache.update_plot_jobs(keys, failures)
+        cache.save()
+
+def publish_page(df_html, init_date, region):
+    html_fname = region['html_fname']
+    if cache is not None:
+        key = page_hash(df_html, region['header_fname'], region['footer_fname'])
+        if cache.is_current(html_fname, key):
+            print('...HTML file is unchanged ({0})'.format(html_fname))
+            return
+    write_html_page(df_html, html_fname, region['header_fname'], region['footer_fname'])
+    if cache is not None:
+        cache.update(html_fname, key, init_date)
+        cache.save()
+
+def build_table(ds, name, region):
+    ## ds has one variable per forecast variable (see run_compare_mclimate_forecasts)
+    df = create_html_table(ds.sortby('lat'), name, ext=region['table_ext'], img_path=region['img_path'])
+    ## convert to html
+    return df.to_html(index=False, formatters={'Hour': lambda x: '<b>' + x + '</b>'}, escape=False)
+
+def publish_tables(ds):
+    ## tables are small; every region is built from the same comparison
+    for name, region in regions.items():
+        print('...Building {0} Table'.format(name))
+        df_html = build_table(ds, name, region)
+        publish_page(df_html, ds.init_date.values, region)
+
+def run_streaming(fdate):
+    print('...Streaming {0} M-Climate comparison'.format(', '.join(varname_lst)))
+    ds_lst = []
+    for step, results in mclim_func.iter_compare_mclimate_forecast(varname_lst, fdate, models, server='skyriver', mode=mode,
+                                                                    optional=optional_varnames):
+        print('...Writing F{0} plots'.format(step))
+        ds = mclim_func.merge_mclimate_results(results, optional=optional_varnames)
+        plot_jobs = []
+        for name, region in regions.items():
+            plot_jobs += region_plot_jobs(region, results)
+        render_plots(plot_jobs, nprocs=min(nprocs, len(plot_jobs)))
+
+        ## only the comparison is kept, the forecast for this lead time is released
+        ds_lst.append(ds)
+        publish_tables(xr.concat(ds_lst, dim='step'))
+
+def run_batch(fdate):
+    ##################
+    ### COMPARISON ###
+    ##################
+    ## every variable is read at once and compared on the same grid for the same initialization date
+    print('...Reading {0} data for M-Climate comparison'.format(', '.join(varname_lst)))
+    results, ds = mclim_func.run_compare_mclimate_forecasts(varname_lst, fdate, models, server='skyriver', mode=mode,
+                                                              optional=optional_varnames)
+    
+    if product_dir is not None:
+        for varname in results:
+            print('...Wrote {0}'.format(mclim_func.write_mclimate_product(results[varname][1], varname, product_dir)))
+
+    #############
+    ### PLOTS ###
+    #############
+    ## the plots of every region go to one process pool, and each variable is shared with the workers once
+    print('...Writing M-Climate plots for {0} regions'.format(len(regions)))
+    plot_jobs = []
+    for name, region in regions.items():
+        plot_jobs += region_plot_jobs(region, results)
+    render_plots(plot_jobs, nprocs=nprocs)
+
+    ##################################
+    ### BUILD TABLE AND WRITE HTML ###
+    ##################################
+    publish_tables(ds)
+
+def run_pipeline(fdate):
+    if streaming:
+        run_streaming(fdate)
+    else:
+        run_batch(fdate)
+    instrument.write_record(instrument_dir, model=model, mode=mode, streaming=streaming, fdate=fdate)
+
+def latest_ready_init():
+    ## newest init with complete files for every required variable, None if it is not ready yet
+    ## (optional variables, e.g., GFS uv1000, do not hold back the other products)
+    required = [varname for varname in varname_lst if varname not in optional_varnames]
+    try:
+        s = get_loader(required[0], None)
+        loader_lst = [s] + [get_loader(varname, s.date_string) for varname in required[1:]]
+    except (FileNotFoundError, ValueError):
+        return None
+    ready = all([all([s1.step_ready(step) for step in s1.step_lst]) for s1 in loader_lst])
+    return s.date_string if ready else None
+
+def get_loader(varname, fdate):
+    if models[varname] == 'GFS':
+        return ctools.load_GFS_datasets(varname, fdate)
+    return ctools.load_GEFS_datasets(varname, fdate)
+
+def run_daemon():
+    ## the mclimate, regrid weights and plot workers (with their maps) stay in memory between forecasts
+    print('...Watching for new {0} forecasts every {1} s'.format(model, poll_interval))
+    done = None
+    attempts = {}
+    while True:
+        fdate = latest_ready_init()
+        if (fdate is not None) and (fdate != done) and (attempts.get(fdate, 0) < max_attempts):
+            print('...Processing {0}'.format(fdate))
+            attempts[fdate] = attempts.get(fdate, 0) + 1
+            if instrument.enabled:
+                instrument.new_run()
+            try:
+                run_pipeline(fdate)
+                done = fdate
+            except Exception:
+                print('...Failed to process {0} (attempt {1} of {2})'.format(fdate, attempts[fdate], max_attempts))
+                traceback.print_exc()
+        time.sleep(poll_interval)
+
+if daemon:
+    run_daemon()
+else:
+    run_pipeline(fdate)